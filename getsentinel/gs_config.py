@@ -35,6 +35,20 @@ class UserConfig():
         The relative or absolute filepath to the data storage directory.
     QUICKLOOKS_PATH : str
         The relative or absolute filepath to the quicklooks storage directory.
+    INVENTORY_JOURNAL : str
+        Optional journal mode of the product inventory database, 'wal' for a
+        write-ahead log. Defaults to a rollback journal if not set.
+    DATA_BUDGET : int or str
+        Optional size budget for the products in the DATA_PATH, in bytes or
+        as a string such as '500 GB'. See `gs_localmanager.evict_products`.
+    SHARED_STORE : str
+        Optional path to a product store shared by the users of a host.
+        Downloaded products are kept there and hard-linked into the DATA_PATH,
+        which must be on the same file system to avoid copies.
+    PROCESSING_MEMORY : float
+        Optional memory in GB that processing jobs may use together.
+    PROCESSING_CPUS : int
+        Optional number of CPUs that processing jobs may use together.
     """
 
     def __init__(self):
@@ -69,6 +83,26 @@ class UserConfig():
     def QUICKLOOKS_PATH(self):
         return self.get_property('quicklooks_path')
 
+    @property
+    def INVENTORY_JOURNAL(self):
+        return self.get_property('inventory_journal')
+
+    @property
+    def DATA_BUDGET(self):
+        return self.get_property('data_budget')
+
+    @property
+    def SHARED_STORE(self):
+        return self.get_property('shared_store')
+
+    @property
+    def PROCESSING_MEMORY(self):
+        return self.get_property('processing_memory')
+
+    @property
+    def PROCESSING_CPUS(self):
+        return self.get_property('processing_cpus')
+
 
 def _get_config():
     """Loads in the config details from the gs_config.json file."""
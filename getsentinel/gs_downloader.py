@@ -26,33 +26,81 @@ Basic usage example::
     # optionally filter overlapping products from a given region
     # query.ROI contains a polygon generated from the input coordinates
     product_list = gs_downloader.filter_overlaps(product_list, query.ROI)
+    # optionally keep only the newest processing baseline of each acquisition
+    product_list = gs_downloader.dedupe_baselines(product_list)
 
     # optinally download the corresponding product quicklooks
     hub.download_quicklooks(product_list)
     hub.download_products(product_list)
 
+    # optionally download the newest products first, capped at 5 MB/s and
+    # only overnight
+    schedule = gs_downloader.DownloadSchedule(
+        priority='newest',
+        max_rate=5 * 1024**2,
+        windows=[(datetime.time(22), datetime.time(6))])
+    hub.download_products(product_list, schedule=schedule)
+
+    # optionally only page through products ingested since the last run,
+    # passing the query on so its watermark advances past the products that
+    # were downloaded
+    query.incremental_mode('nightly')
+    total_products, product_list = hub.submit_query(query)
+    hub.download_products(product_list, query=query)
+
 """
 
 # TODO
 # ----
 # Revise 'BEST' product filtering to use sets(?) / be more efficient
 
+import collections
+import concurrent.futures
 import datetime
 import os
+import json
 import xml.etree.ElementTree as ET
 import warnings
 import hashlib
 import pathlib
+import shutil
+import socket
+import tempfile
+import time
 import zipfile
 import requests
 from clint.textui import progress
 import shapefile
 import geojson
 from shapely.geometry import MultiPoint, Polygon
+from shapely.prepared import prep
 from shapely.wkt import loads
 from osgeo import ogr, osr
 from . import gs_localmanager
 from .gs_config import UserConfig
+from .gs_product import Product, as_product
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+WATERMARKS_FILE = 'query_watermarks.json'
+SEARCH_URL = 'https://scihub.copernicus.eu/dhus/search'
+OPENSEARCH_NS = '{http://a9.com/-/spec/opensearch/1.1/}'
+# Hedged requests: delay before a duplicate request is sent, taken from the
+# given percentile of recent request latencies once enough are recorded
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 10
+HEDGE_DEFAULT_DELAY = 2.0
+HEDGE_MIN_DELAY = 0.5
+# Vertex budget for the geometry sent to the hub in the intersects() clause
+MAX_QUERY_VERTICES = 50
+# Linux ioctl sharing the data of one file with another, i.e. a reflink
+FICLONE = 0x40049409
+# Incremental queries also ask for products ingested this long before the
+# watermark, which the hub may have indexed late
+WATERMARK_OVERLAP = datetime.timedelta(days=1)
 
 
 class Query:
@@ -92,6 +140,9 @@ class Query:
         The processing level of the products desired from the query
     details : dict
         Contains optional parameters for the query
+    incremental : bool
+        If True, only products ingested since the last run of this query are
+        returned. See the `incremental_mode` method.
 
     """
 
@@ -105,6 +156,8 @@ class Query:
             raise ValueError(" Only Sentinel-1 (use 'S1') and Sentinel-2 (use"
                              " 'S2') products are currently supported.")
         self.satellite = satellite
+        self.incremental = False
+        self._watermark_name = False
 
     def acquisition_date_range(self, acqstart, acqend=False):
         """Set the date range for the query.
@@ -373,6 +426,157 @@ class Query:
                         'resolution:': resolution,
                         'orbitdirection:': orbitdirection}
 
+    def incremental_mode(self, name=False):
+        """Only return products ingested since the last run of this query.
+
+        Once the products returned by `CopernicusHubConnection.submit_query`
+        are downloaded, `CopernicusHubConnection.commit_watermark` (called by
+        `download_products` when passed the query) stores the latest
+        `ingestiondate` up to which all of them are in the inventory as a
+        watermark in the DATA_PATH. Later submissions of the same query add an
+        `ingestiondate:[watermark TO NOW]` term, less `WATERMARK_OVERLAP`, so
+        only new products and those not downloaded yet are paged.
+
+        Note
+        ----
+        By default the watermark is keyed on all of the query parameters,
+        including the dates. Queries whose date range changes between runs,
+        e.g. a season window that ends today, must pass a `name` so that they
+        share a watermark.
+
+        Parameters
+        ----------
+        name : str, optional
+            Name under which the watermark of this query is stored.
+
+        Returns
+        -------
+        None
+
+        """
+
+        self.incremental = True
+        self._watermark_name = name
+
+    def watermark_key(self):
+        """Returns the key under which the query watermark is stored."""
+
+        if self._watermark_name:
+            return self._watermark_name
+
+        details = sorted((key, value) for key, value in
+                         getattr(self, 'details', {}).items() if value)
+        key = repr((self.satellite,
+                    str(self.dates[0]),
+                    str(self.dates[1]),
+                    self.ROI.wkt if self.coordinates else None,
+                    getattr(self, 'proclevel', False),
+                    getattr(self, 'cloudcoverlimit', None),
+                    details))
+
+        return hashlib.md5(key.encode('utf8')).hexdigest()
+
+
+class DownloadSchedule:
+    """Holds the priority and resource limits for a batch of downloads.
+
+    Passed to `CopernicusHubConnection.download_products` to control the order
+    in which products are downloaded and when and how fast they are fetched.
+
+    Parameters
+    ----------
+    priority : str or callable, optional
+        Order of the download queue: 'newest' or 'oldest' sensing date first,
+        or 'smallest' or 'largest' product first. A callable is used as the
+        sort key and is passed `(uuid, product)`, e.g. to rank by ROI
+        importance. Default is the order the products are supplied in.
+    disk_budget : int, optional
+        Maximum number of bytes the batch may add to the DATA_PATH.
+    disk_reserve : int, optional
+        Number of bytes that must stay free under the DATA_PATH. Products that
+        would cross the reserve are skipped. Default is 0.
+    max_rate : int, optional
+        Bandwidth cap for downloads in bytes per second.
+    windows : list, optional
+        `list` of (start, end) `datetime.time` tuples giving the times of day
+        at which downloads may start. Windows may wrap past midnight, e.g.
+        `[(datetime.time(22), datetime.time(6))]`.
+
+    """
+
+    def __init__(self, priority=False, disk_budget=False, disk_reserve=0,
+                 max_rate=False, windows=False):
+
+        if priority and not callable(priority) and priority not in [
+                'newest', 'oldest', 'smallest', 'largest']:
+            raise ValueError("Priority must be 'newest', 'oldest', 'smallest',"
+                             " 'largest' or a callable sort key.")
+        for window in windows or []:
+            if (len(window) != 2 or
+                    not all(type(t) is datetime.time for t in window)):
+                raise TypeError("Download windows must be (start, end) tuples"
+                                " of datetime.time objects.")
+
+        self.priority = priority
+        self.disk_budget = disk_budget
+        self.disk_reserve = disk_reserve
+        self.max_rate = max_rate
+        self.windows = windows
+
+    def order(self, productlist):
+        """Returns the product UUIDs in the order they should be downloaded.
+
+        Products without the sensing date or size to be sorted by come last,
+        in the order supplied.
+        """
+
+        uuids = list(productlist.keys())
+        priority = self.priority
+
+        if not priority:
+            return uuids
+        if callable(priority):
+            return sorted(uuids, key=lambda uuid: priority(uuid,
+                                                           productlist[uuid]))
+        if priority in ['newest', 'oldest']:
+            keys = {uuid: productlist[uuid].get('beginposition')
+                    for uuid in uuids}
+        else:
+            # _parse_size gives 0 for missing or unknown sizes
+            keys = {uuid: _parse_size(productlist[uuid].get('size')) or None
+                    for uuid in uuids}
+
+        known = [uuid for uuid in uuids if keys[uuid]]
+        unknown = [uuid for uuid in uuids if not keys[uuid]]
+
+        return sorted(known, key=keys.get,
+                      reverse=priority in ['newest', 'largest']) + unknown
+
+    def in_window(self, now=None):
+        """Checks whether downloads may start at the given time."""
+
+        if not self.windows:
+            return True
+        if now is None:
+            now = datetime.datetime.now().time()
+
+        for start, end in self.windows:
+            if start <= end and start <= now < end:
+                return True
+            if start > end and (now >= start or now < end):  # wraps midnight
+                return True
+
+        return False
+
+    def wait_for_window(self, poll=60):
+        """Blocks until the current time falls within a download window."""
+
+        if self.in_window():
+            return
+        print("Waiting for the next download window.")
+        while not self.in_window():
+            time.sleep(poll)
+
 
 class CopernicusHubConnection:
     """Handles queries and product downloads to and from the ESA SciHub.
@@ -385,16 +589,38 @@ class CopernicusHubConnection:
         The user's ESA account username.
     password : str
         The user's ESA account password.
+    response_format : str
+        The format search responses are requested in, 'xml' or 'json'.
+    hedge : bool
+        Whether idempotent requests are hedged.
+
+    Parameters
+    ----------
+    response_format : str, optional
+        Request search results as the 'xml' Atom feed or in the hub's 'json'
+        format, which is smaller to transfer and faster to parse. Both are
+        returned in the same product dict format. Default is 'xml'.
+    hedge : bool, optional
+        If True, search pages, checksums and quicklooks that have not
+        responded within the 95th percentile of recent request latencies are
+        sent a second time and the first response is used. Default is False.
 
     """
 
-    def __init__(self):
+    def __init__(self, response_format='xml', hedge=False):
+
+        if response_format not in ['xml', 'json']:
+            raise ValueError("Response format must be 'xml' or 'json'.")
 
         self.config = UserConfig()
         self.username = self.config.ESA_USERNAME
         self.password = self.config.ESA_PASSWORD
+        self.response_format = response_format
+        self.hedge = hedge
+        self._latencies = collections.deque(maxlen=100)
+        self._hedge_pool = None
 
-    def raw_query(self, query):
+    def raw_query(self, query, rows=False):
         """Queries the ESA SciHub with a pre-formatted query.
 
         Note
@@ -406,6 +632,9 @@ class CopernicusHubConnection:
         ----------
         query : str
             Pre-forammted search query string.
+        rows : int, optional
+            Number of results to return, at most 100. Default is the hub
+            default of 10.
 
         Returns
         -------
@@ -417,9 +646,10 @@ class CopernicusHubConnection:
 
         """
 
-        url = 'https://scihub.copernicus.eu/dhus/search?q=' + query
-        r = requests.get(url, auth=(self.username, self.password))
-        response = ET.fromstring(r.content)  # parse to XML
+        params = {'q': query}
+        if rows:
+            params['rows'] = str(rows)
+        response = self._search(params)
 
         total_results, product_list = self._handle_response(response, False)
 
@@ -467,19 +697,13 @@ class CopernicusHubConnection:
             procfilter = True
 
         def send_query(query):
-            r = requests.get('https://scihub.copernicus.eu/dhus/search',
-                             params=query,
-                             auth=(self.username, self.password))
             nonlocal response
-            response = ET.fromstring(r.content)  # parse to XML
+            response = self._search(query)
 
         def get_index_results():
-                # get the current results index and results per page
-            index = int(response.findall('{http://a9.com/-/spec/opensearch/'
-                                         '1.1/}startIndex')[0].text)
-            results_per_page = int(response.findall('{http://a9.com/-/spec/'
-                                                    'opensearch/1.1/}items'
-                                                    'PerPage')[0].text)
+            # get the current results index and results per page
+            index = int(self._feed_value(response, 'startIndex'))
+            results_per_page = int(self._feed_value(response, 'itemsPerPage'))
             return index + results_per_page
 
         # send first query to the server, will return default results 1 to 100
@@ -491,8 +715,7 @@ class CopernicusHubConnection:
         # gets the total amount of products that match the search query
         # this number is used to define how far we need to iterate through
         # the search pages (ESA enforces a limit of 100 results per page)
-        total_results = int(response.findall('{http://a9.com/-/spec/opensearch'
-                                             '/1.1/}totalResults')[0].text)
+        total_results = int(self._feed_value(response, 'totalResults'))
 
         # while the number of results processed is less than the current page
         # index + the amount of results on the page
@@ -514,10 +737,70 @@ class CopernicusHubConnection:
             print("Processing filter discarded {0} sub-optimally processed "
                   "products".format(total_results - num_results))
 
+        # the hub was queried with a simplified geometry containing the ROI,
+        # so discard any products that do not intersect the exact ROI
+        num_refined = len(product_list)
+        product_list = _refine_to_ROI(product_list, parameters.ROI)
+        num_results = len(product_list)
+        if num_refined != num_results:
+            print("ROI refinement discarded {0} products outside the exact"
+                  " ROI".format(num_refined - num_results))
+
         print("No. Products returned: {0}".format(num_results))
 
         return num_results, product_list
 
+    def commit_watermark(self, parameters, products):
+        """Advances the watermark of an incremental query past the products
+        that have reached the inventory.
+
+        The watermark is moved to the latest `ingestiondate` up to which all
+        the products passed are in the inventory, so products that were not
+        downloaded, e.g. after a failure or for lack of disk space, are
+        returned again by the next run of the query. Products returned by the
+        query but filtered out deliberately should not be passed.
+
+        Parameters
+        ----------
+        parameters : :obj:`Query`
+            The incremental query the products were returned by.
+        products : dict
+            The products of the query that were to be downloaded, keyed by
+            their product UUID.
+
+        Returns
+        -------
+        None
+
+        """
+
+        if not parameters.incremental:
+            return
+
+        product_inventory = gs_localmanager.get_product_inventory()
+        # manually added products may be inventoried under a local UUID
+        inventoried_files = {info['filename'] for info in
+                             product_inventory.values()}
+
+        ingested = []
+        missing = []
+        for uuid, product in products.items():
+            if not product.get('ingestiondate'):
+                continue
+            if (uuid in product_inventory or
+                    product.get('filename') in inventoried_files):
+                ingested.append(product['ingestiondate'])
+            else:
+                missing.append(product['ingestiondate'])
+
+        if missing:
+            # ISO 8601 timestamps in UTC sort chronologically as strings
+            ingested = [date for date in ingested if date < min(missing)]
+            print("{0} products have not been downloaded yet, the query "
+                  "watermark is kept before them.".format(len(missing)))
+
+        _update_watermark(parameters.watermark_key(), ingested)
+
     def download_quicklooks(self, productlist, downloadpath=None):
         """Downloads the quicklooks of  products to a specified directory.
 
@@ -554,22 +837,29 @@ class CopernicusHubConnection:
             if product['identifier'] in existing_quicklooks:
                 pass  # skip if already downloaded
             url = product['quicklookdownload']
-            response = requests.get(url,
-                                    auth=(self.username, self.password),
-                                    stream=True)
+            response = self._get(url, stream=True)
             filename = os.path.join(downloadpath, product['identifier'])+'.jp2'
             if response.status_code == 500:  # If no quicklook available
                 url = ('https://scihub.copernicus.eu/dhus/images/'
                        'bigplaceholder.png')
-                response = requests.get(url, stream=True)
+                response = self._get(url, auth=None, stream=True)
             with open(filename, 'wb') as handle:
                 for chunk in response.iter_content(chunk_size=512):
                     if chunk:  # filter out keep-alive new chunks
                         handle.write(chunk)
 
-    def download_products(self, products, verify=False):
+    def download_products(self, products, verify=False, schedule=None,
+                          query=None):
         """Downloads the products product_list to the downloadpath directory.
 
+        If a `data_budget` is set in the gs_config.json, the least recently
+        used products are evicted to make room for each download, see
+        `gs_localmanager.evict_products`.
+
+        If a `shared_store` is set in the gs_config.json, products found there
+        are linked into the DATA_PATH instead of being downloaded, and
+        downloaded products are added to it for other users.
+
         Parameters
         ----------
         productlist : dict
@@ -577,24 +867,51 @@ class CopernicusHubConnection:
             product UUID
         verify : bool
             If true, downloads are checked using MD5 checksum
+        schedule : :obj:`DownloadSchedule`, optional
+            Sets the download order, the disk budget, the bandwidth cap and the
+            times of day at which downloads may run.
+        query : :obj:`Query`, optional
+            The incremental query the products were returned by. Its
+            watermark is advanced past the products downloaded, see
+            `commit_watermark`, even if a download fails.
 
         Returns
         -------
         None
         """
 
+        try:
+            self._download_products(products, verify, schedule)
+        finally:
+            if query is not None:
+                self.commit_watermark(query, products)
+
+    def _download_products(self, products, verify, schedule):
+        """Downloads the products, see `download_products`."""
+
         # Copy the dict so that it doesnt get cleared and can still be used in
         # a parent script
         productlist = products.copy()
         downloadpath = self.config.DATA_PATH  # imported from gs_config
         product_inventory = gs_localmanager.get_product_inventory()
-        already_downloaded = list(product_inventory.keys())
+        already_downloaded = set(product_inventory.keys())
+        # manually added products may be inventoried under a local UUID
+        downloaded_files = {info['filename'] for info in
+                            product_inventory.values()}
+
+        if schedule is None:
+            schedule = DownloadSchedule()
+        budget_used = 0
 
         total_products = len(productlist)
         i = 1  # used for product count
 
-        for uuid, product in productlist.copy().items():
-            if uuid in already_downloaded:  # skip files already downloaded
+        _clear_stale_partials(downloadpath)
+
+        for uuid in schedule.order(productlist):
+            product = productlist[uuid]
+            if (uuid in already_downloaded or  # skip files already downloaded
+                    product.get('filename') in downloaded_files):
                 print("Product {0} with UUID {1} is already present in the"
                       " download directory - skipping.".format(
                           product['filename'],
@@ -603,30 +920,74 @@ class CopernicusHubConnection:
                 i = i + 1
                 continue
 
-            print("Downloading product {0} / {1}.".format(i, total_products))
-            filename = self._download_single_product(uuid,
-                                                     downloadpath,
-                                                     verify)
-            zip_ref = zipfile.ZipFile(filename, 'r')
-            extract_to = downloadpath
-            print("Extracting the .zip file.")
-            zip_ref.extractall(extract_to)
-            zip_ref.close()
-            # remove leftover .zip file
-            pathlib.Path(filename).unlink()
-            # add products iteratively so that if process crashes at any point,
-            # earlier products downloaded in the chain will be present in the
-            # inventory.
-            gs_localmanager.add_new_products({uuid: product})
+            shared = _shared_entry(uuid)
+            if shared is not None:
+                print("Linking product {0} from the shared store.".format(
+                    product['filename']))
+                extract_to = _make_partial(downloadpath)
+                try:
+                    _link_tree(shared, extract_to)
+                    _add_download(uuid, product, extract_to, downloadpath)
+                finally:
+                    shutil.rmtree(str(extract_to), ignore_errors=True)
+                i = i + 1
+                continue
+
+            # the .zip and the extracted product are on disk at the same time
+            size = _parse_size(product.get('size'))
+            if (schedule.disk_budget and
+                    budget_used + size > schedule.disk_budget):
+                print("Product {0} exceeds the disk budget - skipping."
+                      "".format(product['filename']))
+                i = i + 1
+                continue
+            if self.config.DATA_BUDGET is not None:
+                # make room within the budget for the .zip and the product
+                gs_localmanager.evict_products(reserve=2 * size)
+            free = shutil.disk_usage(downloadpath).free
+            if 2 * size > free - schedule.disk_reserve:
+                print("Not enough free space for product {0} - skipping."
+                      "".format(product['filename']))
+                i = i + 1
+                continue
+
+            schedule.wait_for_window()
+
+            # download and extract out of sight of other processes checking
+            # the DATA_PATH
+            extract_to = _make_partial(downloadpath)
+            try:
+                print("Downloading product {0} / {1}.".format(
+                    i, total_products))
+                filename = self._download_single_product(uuid,
+                                                         extract_to,
+                                                         verify,
+                                                         schedule.max_rate)
+                print("Extracting the .zip file.")
+                if self.config.SHARED_STORE:
+                    shared = _add_to_shared_store(uuid, filename)
+                    _link_tree(shared, extract_to)
+                else:
+                    zip_ref = zipfile.ZipFile(filename, 'r')
+                    zip_ref.extractall(str(extract_to))
+                    zip_ref.close()
+                # remove leftover .zip file
+                pathlib.Path(filename).unlink()
+                budget_used = budget_used + size
+                _add_download(uuid, product, extract_to, downloadpath)
+            finally:
+                shutil.rmtree(str(extract_to), ignore_errors=True)
             i = i + 1
 
     def _download_single_product(self,
                                  uuid: str,
                                  downloadpath: str,
-                                 verify: bool = False):
+                                 verify: bool = False,
+                                 max_rate: int = False):
         """
         Downloads a single product from its uuid and verifies the download
-        using MD5 checksum if verify = True.
+        using MD5 checksum if verify = True. The download is throttled to
+        max_rate bytes per second if given.
         """
 
         downloadurl = ("https://scihub.copernicus.eu/dhus/odata/v1/"
@@ -647,12 +1008,21 @@ class CopernicusHubConnection:
                 print('Downloading product: \n {0}  \nwith UUID:'
                       '{1}'.format(filename,
                                    uuid))
+                started = time.monotonic()
+                received = 0
                 for chunk in progress.bar(
                         response.iter_content(chunk_size=1024),
                         expected_size=(filelength/1024) + 1):
                     if chunk:  # filter out keep-alive new chunks
                         handle.write(chunk)
                         handle.flush()
+                    if max_rate:
+                        # sleep off any time we are ahead of the capped rate
+                        received = received + len(chunk)
+                        ahead = (received / max_rate -
+                                 (time.monotonic() - started))
+                        if ahead > 0:
+                            time.sleep(ahead)
         except KeyboardInterrupt:
             filepath.unlink()
             exit()
@@ -662,8 +1032,7 @@ class CopernicusHubConnection:
             checksumurl = ("https://scihub.copernicus.eu/dhus/odata/v1/"
                            "Products('{0}')/Checksum/Value/$value"
                            ).format(uuid)
-            response = requests.get(checksumurl,
-                                    auth=(self.username, self.password))
+            response = self._get(checksumurl)
             # ESA supplied MD5 checksum for file
             checksum = response.content.decode('utf8').lower()
             md5hash = hashlib.md5()
@@ -677,37 +1046,108 @@ class CopernicusHubConnection:
                                      '').format(filename, uuid))
         return filepath
 
+    def _search(self, query: dict):
+        """
+        Sends a search request to the hub in the configured response format,
+        negotiating a gzip compressed transfer, and returns the parsed
+        response.
+        """
+
+        params = dict(query)
+        if self.response_format == 'json':
+            params['format'] = 'json'
+
+        r = self._get(SEARCH_URL,
+                      params=params,
+                      headers={'Accept-Encoding': 'gzip, deflate'})
+
+        if self.response_format == 'json':
+            return r.json()['feed']
+        return ET.fromstring(r.content)  # parse to XML
+
+    def _get(self, url: str, **kwargs):
+        """
+        Sends an idempotent GET request with the user's credentials. If
+        hedging is enabled and no response has arrived within the hedge delay
+        a duplicate request is sent, the first response wins and the other is
+        closed when it completes.
+        """
+
+        kwargs.setdefault('auth', (self.username, self.password))
+
+        def timed_get():
+            started = time.monotonic()
+            response = requests.get(url, **kwargs)
+            self._latencies.append(time.monotonic() - started)
+            return response
+
+        if not self.hedge:
+            return timed_get()
+
+        if self._hedge_pool is None:
+            self._hedge_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=4)
+
+        primary = self._hedge_pool.submit(timed_get)
+        try:
+            return primary.result(timeout=self._hedge_delay())
+        except concurrent.futures.TimeoutError:
+            pass
+
+        backup = self._hedge_pool.submit(timed_get)
+        requests_sent = {primary, backup}
+        winner = primary  # re-raises the error if both requests fail
+        pending = requests_sent
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            # use the other request if the first to finish failed
+            succeeded = [future for future in done
+                         if future.exception() is None]
+            if succeeded:
+                winner = succeeded[0]
+                break
+
+        def close_loser(future):
+            if future.exception() is None:
+                future.result().close()
+
+        for future in requests_sent - {winner}:
+            future.add_done_callback(close_loser)
+
+        return winner.result()
+
+    def _hedge_delay(self):
+        """Returns how long to wait before hedging a request, in seconds."""
+
+        if len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+
+        latencies = sorted(self._latencies)
+        index = int(HEDGE_PERCENTILE / 100 * (len(latencies) - 1))
+
+        return max(HEDGE_MIN_DELAY, latencies[index])
+
+    def _feed_value(self, response, name: str):
+        """Returns an OpenSearch value, e.g. 'totalResults', of a response."""
+
+        if isinstance(response, dict):
+            return response['opensearch:' + name]
+        return response.findall(OPENSEARCH_NS + name)[0].text
+
     def _handle_response(self,
-                         response: ET.Element,
+                         response,
                          procfilter: bool):
         """
-        Handles the query response using the xml library. Formats the xml data
-        into usable dict format and also filters for highest processing level
-        of each product if procfilter = True.
+        Handles the XML or JSON query response. Formats the data into usable
+        dict format and also filters for highest processing level of each
+        product if procfilter = True.
         """
 
-        entries = response.findall('{http://www.w3.org/2005/Atom}entry')
-
-        # convert from XML to dictionary format
-        productlist = {}
-
-        for entry in entries:
-            product = {}
-            for field in entry:
-                if field.get('href') is not None:
-                    if field.get('href').endswith("('Quicklook')/$value"):
-                        product['quicklookdownload'] = field.get('href')
-                        continue
-                    if field.get('href').endswith('$value'):  # download links
-                        product['downloadlink'] = field.get('href')
-                if field.get('name') == 'uuid':
-                    uuid = field.text
-                    product['origin'] = field.text
-                    continue
-                if field.get('name') != 'None':  # contain redudancies
-                    product[field.get('name')] = field.text
-            product['userprocessed'] = False
-            productlist[uuid] = product
+        if isinstance(response, dict):
+            productlist = _json_products(response)
+        else:
+            productlist = _xml_products(response)
 
         # filter out S2 L1C products if equivalent L2A exists
         def proc_fail_warning(id1, id2):
@@ -794,7 +1234,8 @@ class CopernicusHubConnection:
         # Formatting the co-ordinates intersect query
 
         value = '"intersects('
-        value = value + parameters.ROI.wkt  # add the ROI WKT format to query
+        # add a bounded WKT polygon containing the ROI to the query
+        value = value + _bounded_ROI(parameters.ROI).wkt
         value = value + ')"'
         field = 'footprint:'
         term_join(field, value)
@@ -824,6 +1265,20 @@ class CopernicusHubConnection:
             if parameters.proclevel == 'L2A':
                 term_join(field, 'S2MSI2A')
 
+        # In incremental mode only ask for products ingested since the
+        # watermark of this query
+        if parameters.incremental:
+            watermark = _get_watermarks().get(parameters.watermark_key())
+            if watermark:
+                # e.g. '2015-08-24T15:55:01.836Z', to the second
+                since = (datetime.datetime.strptime(watermark[:19],
+                                                    '%Y-%m-%dT%H:%M:%S') -
+                         WATERMARK_OVERLAP)
+                field = 'ingestiondate:'
+                value = '[{0} TO NOW]'.format(
+                    since.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+                term_join(field, value)
+
         # Add the start and end row limits for the query
         query['start'] = str(start)
         query['rows'] = str(rows)
@@ -852,29 +1307,16 @@ def filter_overlaps(product_list, ROI, external_list=False):
 
     """
 
-    def extract_time(time_string):
-        # creates a datetime object from the given time string
-        sense_year = int(time_string[0:4])
-        sense_month = int(time_string[5:7])
-        sense_day = int(time_string[8:10])
-        sense_hour = int(time_string[11:13])
-        sense_minute = int(time_string[14:16])
-        sense_second = int(time_string[17:19])
-        time = datetime.datetime(sense_year,
-                                 sense_month,
-                                 sense_day,
-                                 sense_hour,
-                                 sense_minute,
-                                 sense_second)
-        return time
+    # footprints and sensing times are parsed once per product
+    parsed = {uuid: as_product(product) for uuid, product in
+              product_list.items()}
 
     encompassing_products = []
 
     num_products_passed = len(product_list)
 
     for uuid, product in product_list.copy().items():
-        # format the footprint string for use with pyshp
-        footprint = loads(product['footprint'])  # load in via shapely
+        footprint = parsed[uuid].shape
         # if ROI fully encompassed by a product
         if ROI.within(footprint):
             encompassing_products.append(uuid)
@@ -913,17 +1355,14 @@ def filter_overlaps(product_list, ROI, external_list=False):
 
             prodtype = product['producttype']
             polarisation = product['polarisationmode']
-            sensing_begin = product['beginposition']
-            sensing_begin = extract_time(sensing_begin)
-            sensing_end = product['endposition']
-            sensing_end = extract_time(sensing_end)
+            sensing_begin = parsed[uuid].begin
+            sensing_end = parsed[uuid].end
 
             for uuid2, product2 in product_list_copy.items():
                 if (uuid is uuid2 or product2['platformname'] !=
                   product['platformname']): # noqa
                     continue
-                sensing_begin_2 = product2['beginposition']
-                sensing_begin_2 = extract_time(sensing_begin_2)
+                sensing_begin_2 = parsed[uuid2].begin
                 # If second product has sensing time before the end of first
                 # product, that indicates data overlap
                 if (sensing_begin < sensing_begin_2 < sensing_end):
@@ -940,6 +1379,400 @@ def filter_overlaps(product_list, ROI, external_list=False):
     return product_list
 
 
+def dedupe_baselines(product_list, policy='newest', external_list=False):
+    """Filters out reprocessed copies of the same acquisition.
+
+    The hub can hold a product several times under different processing
+    baselines. Products are grouped by their datatake and tile, parsed from
+    the product identifier, and only one product of each group is retained.
+    Sentinel-2 products are ranked by processing baseline and generation time,
+    Sentinel-1 products by ingestion date.
+
+    Parameters
+    ----------
+    product_list : dict
+        Contains all the products returned from the query, keyed by their
+        product UUID
+    policy : str, optional
+        'newest' keeps the latest baseline of each group, 'oldest' the
+        earliest. Default is 'newest'.
+    external_list : dict, optional
+        Products already present in the inventory. If a group contains one of
+        these it is retained instead, so nothing is downloaded twice.
+
+    Returns
+    -------
+    dict
+        The filtered `product_list`.
+
+    """
+
+    if policy not in ['newest', 'oldest']:
+        raise ValueError("Policy must be 'newest' or 'oldest'.")
+
+    retained = {}  # group key -> (is external, rank, uuid)
+    grouped = set()
+
+    for uuid, product in product_list.items():
+        key = _baseline_key(product)
+        if key is None:  # identifier not in a recognised format, keep it
+            continue
+        group, rank = key
+        grouped.add(uuid)
+        if policy == 'oldest':
+            rank = tuple(_invert(value) for value in rank)
+        candidate = (bool(external_list) and uuid in external_list, rank, uuid)
+        if group not in retained or candidate > retained[group]:
+            retained[group] = candidate
+
+    keep = {uuid for _, _, uuid in retained.values()}
+    num_products_passed = len(product_list)
+
+    for uuid in grouped - keep:
+        product_list.pop(uuid, None)
+
+    print("dedupe_baselines : {0} product(s) filtered"
+          " out.".format(num_products_passed - len(product_list)))
+
+    return product_list
+
+
+def _baseline_key(product):
+    """Splits a product identifier into its acquisition group and a rank of
+    its processing baseline. Returns None for unrecognised identifiers."""
+
+    identifier = product.get('identifier') or product.get('filename', '')
+    identifier = identifier.split('.')[0]
+    parts = identifier.split('_')
+
+    # e.g. S2A_MSIL1C_20180606T104021_N0206_R008_T32ULE_20180606T124804
+    if identifier.startswith('S2') and len(parts) == 7:
+        mission, level, sensing, baseline, orbit, tile, generated = parts
+        return (mission, level, sensing, orbit, tile), (baseline, generated)
+
+    # e.g. S1A_IW_GRDH_1SDV_20150824T062207_20150824T062232_007401_00A2E5_5B2B
+    if identifier.startswith('S1') and len(parts) == 9:
+        return tuple(parts[:8]), (product.get('ingestiondate') or '',
+                                  parts[8])
+
+    return None
+
+
+def _invert(value):
+    """Inverts the sort order of a rank string."""
+
+    return tuple(-ord(char) for char in value)
+
+
+def _xml_products(response):
+    """Converts the entries of an XML search response to product dicts."""
+
+    entries = response.findall('{http://www.w3.org/2005/Atom}entry')
+
+    # convert from XML to dictionary format
+    productlist = {}
+
+    for entry in entries:
+        product = {}
+        for field in entry:
+            if field.get('href') is not None:
+                if field.get('href').endswith("('Quicklook')/$value"):
+                    product['quicklookdownload'] = field.get('href')
+                    continue
+                if field.get('href').endswith('$value'):  # download links
+                    product['downloadlink'] = field.get('href')
+            if field.get('name') == 'uuid':
+                uuid = field.text
+                product['origin'] = field.text
+                continue
+            if field.get('name') != 'None':  # contain redudancies
+                product[field.get('name')] = field.text
+        product['userprocessed'] = False
+        productlist[uuid] = Product(product)
+
+    return productlist
+
+
+def _json_products(response):
+    """Converts the entries of a JSON search response to product dicts."""
+
+    def as_list(value):
+        # the hub returns a bare object instead of a list of one
+        if value is None:
+            return []
+        if isinstance(value, list):
+            return value
+        return [value]
+
+    productlist = {}
+
+    for entry in as_list(response.get('entry')):
+        product = {}
+        for link in as_list(entry.get('link')):
+            href = link.get('href', '')
+            if href.endswith("('Quicklook')/$value"):
+                product['quicklookdownload'] = href
+            elif href.endswith('$value'):  # download links
+                product['downloadlink'] = href
+        for field_type in ['str', 'int', 'double', 'date', 'bool']:
+            for field in as_list(entry.get(field_type)):
+                content = field.get('content')
+                if content is not None and not isinstance(content, str):
+                    content = str(content)  # match the XML text values
+                product[field['name']] = content
+        uuid = product.pop('uuid', entry.get('id'))
+        product['origin'] = uuid
+        product['userprocessed'] = False
+        productlist[uuid] = Product(product)
+
+    return productlist
+
+
+def _parse_size(size_string):
+    """Converts an ESA product size string, e.g. '785.41 MB', to bytes."""
+
+    units = {'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3,
+             'TB': 1024**4}
+
+    try:
+        value, unit = size_string.split()
+        return int(float(value) * units[unit.upper()])
+    except (AttributeError, ValueError, KeyError):  # missing or unknown size
+        return 0
+
+
+def _bounded_ROI(ROI, max_vertices=MAX_QUERY_VERTICES):
+    """Returns a polygon of at most `max_vertices` vertices containing the ROI.
+
+    The convex hull of the ROI is used where it is within the vertex budget.
+    Otherwise the hull is buffered and simplified by increasing tolerances
+    until it is, keeping only candidates that still contain the ROI. The
+    bounding box is the fallback, so the hub results are always a superset of
+    those for the exact ROI.
+    """
+
+    hull = ROI.convex_hull
+    if hull.geom_type != 'Polygon':  # degenerate ROI, nothing to simplify
+        return ROI
+    if len(hull.exterior.coords) - 1 <= max_vertices:
+        return hull
+
+    minx, miny, maxx, maxy = hull.bounds
+    tolerance = max(maxx - minx, maxy - miny) / 1000
+    for _ in range(20):
+        candidate = hull.buffer(tolerance, resolution=2)
+        candidate = candidate.simplify(tolerance).convex_hull
+        if (len(candidate.exterior.coords) - 1 <= max_vertices and
+                candidate.contains(ROI)):
+            return candidate
+        tolerance = tolerance * 2
+
+    return ROI.envelope
+
+
+def _refine_to_ROI(product_list, ROI):
+    """Removes products whose footprints do not intersect the exact ROI."""
+
+    prepared_ROI = prep(ROI)
+
+    for uuid, product in list(product_list.items()):
+        footprint = as_product(product).shape
+        if footprint is not None and not prepared_ROI.intersects(footprint):
+            product_list.pop(uuid, None)
+
+    return product_list
+
+
+def _add_download(uuid, product, extract_to, downloadpath):
+    """Moves an extracted product into the DATA_PATH and adds it to the
+    inventory, unless another process has added it meanwhile."""
+
+    # add products iteratively so that if process crashes at any point,
+    # earlier products downloaded in the chain will be present in the
+    # inventory. The product appears on disk and in the inventory together.
+    with gs_localmanager.inventory_lock():
+        product_inventory = gs_localmanager._get_inventory()
+        if uuid in product_inventory or product.get('filename') in {
+                info['filename'] for info in product_inventory.values()}:
+            print("Product {0} was added by another process meanwhile -"
+                  " discarding this download.".format(product['filename']))
+            return
+        _move_into(extract_to, downloadpath)
+        gs_localmanager.add_new_products({uuid: product})
+
+
+def _make_partial(downloadpath):
+    """Creates a hidden directory in the DATA_PATH for a download in
+    progress, named after this process, see `_clear_stale_partials`."""
+
+    prefix = '.partial-{0}@{1}-'.format(os.getpid(), socket.gethostname())
+
+    return pathlib.Path(tempfile.mkdtemp(prefix=prefix, dir=downloadpath))
+
+
+def _clear_stale_partials(downloadpath):
+    """Removes the download directories left in the DATA_PATH by processes
+    on this host that are no longer running."""
+
+    if os.name == 'nt':  # os.kill cannot probe processes on Windows
+        return
+
+    host = socket.gethostname()
+    for partial in pathlib.Path(downloadpath).glob('.partial-*@*-*'):
+        # e.g. .partial-1234@host-k2x8f_ab
+        owner = partial.name[len('.partial-'):].rsplit('-', 1)[0]
+        pid, _, owner_host = owner.partition('@')
+        if owner_host != host or not pid.isdigit():
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            print("Removing the download left by stopped process {0}."
+                  "".format(pid))
+            shutil.rmtree(str(partial), ignore_errors=True)
+        except OSError:  # running, as another user
+            continue
+
+
+def _shared_entry(uuid):
+    """Returns the directory of a product in the shared store, None if no
+    shared store is configured or it does not hold the product."""
+
+    config = UserConfig()
+    if not config.SHARED_STORE:
+        return None
+
+    product_dir = pathlib.Path(config.SHARED_STORE).joinpath(uuid)
+    if not product_dir.is_dir():
+        return None
+    for entry in sorted(product_dir.iterdir()):
+        # entries still being extracted are hidden
+        if entry.is_dir() and not entry.name.startswith('.'):
+            return entry
+
+    return None
+
+
+def _add_to_shared_store(uuid, zip_path):
+    """Extracts a downloaded product into the shared store and returns its
+    directory there.
+
+    Products are stored as SHARED_STORE/<uuid>/<MD5 checksum of the .zip>.
+    The files are made group-writable, as Linux only lets users hard-link
+    files of other users that they can write to, so the users of the store
+    should share a group, e.g. via a setgid SHARED_STORE directory. The files
+    are hard-linked into the DATA_PATH of every user and must not be modified
+    in place.
+    """
+
+    config = UserConfig()
+    product_dir = pathlib.Path(config.SHARED_STORE).joinpath(uuid)
+    product_dir.mkdir(parents=True, exist_ok=True)
+    entry = product_dir.joinpath(gs_localmanager._hash_file(zip_path))
+    if entry.exists():  # stored meanwhile by another user
+        return entry
+
+    partial = product_dir.joinpath('.partial-{0}'.format(os.getpid()))
+    with zipfile.ZipFile(str(zip_path), 'r') as zip_ref:
+        zip_ref.extractall(str(partial))
+    for root, _, files in os.walk(str(partial)):
+        for name in files:
+            os.chmod(os.path.join(root, name), 0o664)
+
+    try:
+        partial.rename(entry)
+    except OSError:  # stored meanwhile by another user
+        shutil.rmtree(str(partial))
+
+    return entry
+
+
+def _link_tree(source_dir, target_dir):
+    """Recreates the directory tree source_dir at target_dir with the files
+    hard-linked, or reflinked or copied if they are on another file system.
+    """
+
+    source_dir = pathlib.Path(source_dir)
+    for root, _, files in os.walk(str(source_dir)):
+        target = pathlib.Path(target_dir).joinpath(
+            pathlib.Path(root).relative_to(source_dir))
+        target.mkdir(parents=True, exist_ok=True)
+        for name in files:
+            _link_file(os.path.join(root, name), str(target.joinpath(name)))
+
+
+def _link_file(source, target):
+    """Hard-links source to target, falling back on a reflink and then on
+    a copy."""
+
+    try:
+        os.link(source, target)
+        return
+    except OSError:  # e.g. on another file system
+        pass
+
+    if fcntl is not None:
+        with open(source, 'rb') as source_file, \
+                open(target, 'wb') as target_file:
+            try:
+                fcntl.ioctl(target_file.fileno(), FICLONE,
+                            source_file.fileno())
+                return
+            except OSError:  # not supported by the file system
+                pass
+
+    shutil.copyfile(source, target)
+
+
+def _move_into(source_dir, target_dir):
+    """Moves the contents of source_dir into target_dir, replacing any
+    existing entries of the same name, and removes source_dir."""
+
+    for entry in source_dir.iterdir():
+        target = pathlib.Path(target_dir).joinpath(entry.name)
+        if target.is_dir():
+            shutil.rmtree(str(target))
+        elif target.exists():
+            target.unlink()
+        entry.replace(target)
+    source_dir.rmdir()
+
+
+def _get_watermarks():
+    """Loads the incremental query watermarks from the DATA_PATH."""
+
+    config = UserConfig()
+    watermarks_path = pathlib.Path(config.DATA_PATH).joinpath(WATERMARKS_FILE)
+    try:
+        with watermarks_path.open() as read_in:
+            watermarks = json.load(read_in)
+    except (OSError, ValueError):  # no watermarks saved yet
+        watermarks = {}
+
+    return watermarks
+
+
+def _update_watermark(key, ingested):
+    """Advances the watermark of a query to the latest of the ingestion
+    dates."""
+
+    if not ingested:  # nothing new, keep the current watermark
+        return
+
+    config = UserConfig()
+    data_path = pathlib.Path(config.DATA_PATH)
+    data_path.mkdir(exist_ok=True)
+    # ISO 8601 timestamps in UTC sort chronologically as strings
+    watermark = max(ingested)
+    with gs_localmanager.inventory_lock():
+        watermarks = _get_watermarks()
+        if key in watermarks and watermarks[key] >= watermark:
+            return
+        watermarks[key] = watermark
+        gs_localmanager._write_json(data_path.joinpath(WATERMARKS_FILE),
+                                    watermarks, indent=4)
+
+
 class ChecksumError(Exception):
     """Checksum Exception for when checksums do not match in downloading."""
     pass
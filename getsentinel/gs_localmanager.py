@@ -4,8 +4,23 @@ This module provides an up-to-date product inventory and checks the integrity
 of any saved inventory against the actual contents of the DATA_PATH provided by
 the gs_config.
 
-Products are stored as dictionaries containing all the necessary product info.
-See below for example product info format.
+The inventory is stored in a SQLite database, product_inventory.db, in the
+hidden .getsentinel directory of the DATA_PATH, so that database writes do not
+change the DATA_PATH modification time used by `check_integrity`. It is
+updated one product at a time. An existing product_inventory.json, or
+product_inventory.db in the DATA_PATH itself, from an earlier version is
+migrated on first use.
+
+Several processes may share one DATA_PATH. Every read-modify-write of the
+inventory holds an exclusive lock on product_inventory.lock, which callers can
+also take with `inventory_lock` to group several calls, and the .json side
+files are replaced atomically. Setting `inventory_journal` to 'wal' in the
+gs_config.json puts the database in write-ahead log mode so that readers are
+not blocked by writers; leave it unset if the DATA_PATH is on a network share.
+
+Products are stored as dictionaries containing all the necessary product info
+and returned as `gs_product.Product` records, which are dictionaries too. See
+below for example product info format.
 
 Example
 -------
@@ -17,9 +32,28 @@ Example
 
     gs_localmanager.add_new_products(new_downloaded_products)
 
+    # find stored products by tile and date, or covering a region of interest
+    june_products = gs_localmanager.find(platform='S2', tile='32ULE',
+                                         start=datetime.date(2018, 6, 1),
+                                         end=datetime.date(2018, 6, 30))
+    roi_products = gs_localmanager.products_intersecting(query.ROI)
+
+    # products processed from a given product
+    processed_products = gs_localmanager.find_derived(uuid)
+
+    # check the stored product files for corruption
+    failed_products = gs_localmanager.audit_products()
+
+    # remove the least recently used products to fit a size budget
+    evicted_products = gs_localmanager.evict_products('500 GB')
+
+    # follow the products being added, processed and removed
+    for change in gs_localmanager.subscribe():
+        print(change['seq'], change['event'], change['uuid'])
+
 Example Product Info Format
 ---------------------------
-Below is an example format, as stored in the product_inventory.json, of an
+Below is an example format, as stored in the product inventory, of an
 unprocessed Sentinel-1 product. The keys `tileid` and `userprocessed` are
 added by the gs_downloader module. The former denotes the Senntinel-2 MGRS
 tiles that the product traverses, the latter indicates whether the file has
@@ -62,13 +96,70 @@ product originates.
      'tileid': [['30UVE', ...]]
      'userprocessed': False}
 
+Products copied into the DATA_PATH by hand are inventoried from the metadata
+in their .SAFE directories where possible. These records carry the most
+important fields above, are keyed by a UUID generated from the product
+identifier rather than the ESA UUID, and have the extra field
+`localmetadata` set to True.
+
 """
 
+import bisect
+import concurrent.futures
+import datetime
+import hashlib
 import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid as uuidlib
 import warnings
+import xml.etree.ElementTree as ET
+from contextlib import closing, contextmanager
 from pathlib import Path
+from shapely import wkb
+from shapely.prepared import prep
 from .gs_config import UserConfig
+from .gs_product import Product, as_product
 from . import gs_downloader
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+INVENTORY_DB = 'product_inventory.db'
+# directory of the database in the DATA_PATH, hidden from check_integrity
+DB_DIR = '.getsentinel'
+# endings of the database and its journal files
+DB_FILE_SUFFIXES = ['', '-journal', '-wal', '-shm']
+INVENTORY_JSON = 'product_inventory.json'
+MANIFESTS_FILE = 'product_manifests.json'
+LOCK_FILE = 'product_inventory.lock'
+# files in the DATA_PATH used by getsentinel itself, not products
+INTERNAL_SUFFIXES = ['.json', '.db', '.db-journal', '.db-wal', '.db-shm',
+                     '.lock', '.tmp']
+# seconds to wait for another process to finish writing to the database
+DB_TIMEOUT = 60
+# limits for the batched filename queries sent to the hub
+HUB_BATCH_SIZE = 50
+HUB_MAX_QUERY_LENGTH = 4000
+# in-process copy of the inventory, the 'entry' (key, inventory, index) where
+# the key is the database and its version and the index is None until built
+_inventory_cache = {}
+_cache_lock = threading.Lock()
+# databases whose schema has been set up by this process, see _connect
+_schema_ready = set()
+# hash indexes of the cached inventory, see _get_index
+INDEXES = ['platform', 'tile', 'level', 'userprocessed', 'lineage']
+# modification times closer than this to a scan are not trusted, in ns
+MTIME_RESOLUTION_NS = 2 * 10**9
+# holder of the inventory lock within this process
+_thread_lock = threading.RLock()
+_lock_state = {'depth': 0}
 
 
 def _get_new_uuid(uuid):
@@ -81,17 +172,28 @@ def _get_new_uuid(uuid):
     return uuid + '1'
 
 
-def check_integrity():
+def check_integrity(trust_cache=False):
     """Checks the integrity of the current inventory.
 
     Adds any products that were manually added to the DATA_PATH by the user
     since the last check. Removes any missing products.
 
+    The DATA_PATH modification time and inventory version of the last
+    successful check are cached along with the classified DATA_PATH entries.
+    While neither has changed the check returns straight away, and otherwise
+    only entries not seen before are inspected on disk.
+
     Note
     ----
     Any manually added products that have already been processed must be
     explicitly added via `add_new_products`.
 
+    Parameters
+    ----------
+    trust_cache : bool, optional
+        If True and a previous check has been cached, the DATA_PATH is assumed
+        to be unchanged and is not inspected at all. Intended for hot loops.
+
     Returns
     -------
     bool
@@ -112,40 +214,76 @@ def check_integrity():
     data_path = Path(config.DATA_PATH)
     data_path.mkdir(exist_ok=True)
 
-    product_inventory = _get_inventory()
+    cache = _get_meta(['scan_mtime', 'scan_time', 'scan_version',
+                       'version'])
+    if trust_cache and cache['scan_mtime'] is not None:
+        return True
+
+    scan_time = int(time.time() * 1e9)
+    scan_mtime = data_path.stat().st_mtime_ns
+    version = cache['version'] or 0
+    # directory mtimes can be coarse, so a change in the same tick as the
+    # cached scan would go unnoticed. Only trust scans made well after it.
+    if (cache['scan_mtime'] == scan_mtime and
+            cache['scan_version'] == version and
+            cache['scan_time'] - scan_mtime > MTIME_RESOLUTION_NS):
+        return True
+
+    with inventory_lock():
+        _reconcile_data_path(data_path, scan_mtime, scan_time)
+
+    return True
+
+
+def _reconcile_data_path(data_path, scan_mtime, scan_time):
+    """Brings the inventory in line with the DATA_PATH contents, see
+    `check_integrity`. Must be called holding the inventory lock."""
+
+    # classify the DATA_PATH entries, only inspecting those not seen before
+    known_entries = _get_meta(['scan_entries'])['scan_entries'] or {}
+    entries = {}
+    for entry in data_path.iterdir():
+        kind = known_entries.get(entry.name)
+        if kind is None:
+            if entry.name.startswith('.'):  # e.g. downloads in progress
+                kind = 'other'
+            elif entry.name.endswith('.SAFE'):
+                kind = 'safe'
+            elif entry.is_file() and entry.suffix not in INTERNAL_SUFFIXES:
+                kind = 'file'
+            else:
+                kind = 'other'
+        entries[entry.name] = kind
 
     # get all .SAFE file names from directory
-    product_list_add = [x.name for x in list(data_path.glob('*.SAFE'))]
+    safe_products = {name for name, kind in entries.items() if kind == 'safe'}
     # also get all processed files from directory
     # NOTE: need to add the random apple files Joe mentioned to be ignored
     # here.
-    other_files = [x.name for x in list(data_path.glob('*')) if x.is_file() and
-                   not x.suffix == '.json']
-
-    product_inventory_gone = product_inventory.copy()
+    other_files = {name for name, kind in entries.items() if kind == 'file'}
 
-    for uuid, product in product_inventory.items():
-        if product['filename'] in product_list_add:
-            product_inventory_gone.pop(uuid, None)
-            product_list_add.remove(product['filename'])
-        # remove any processed files from the list that are already
-        # inventorised.
-        if product['filename'] in other_files:
-            product_inventory_gone.pop(uuid, None)
-            other_files.remove(product['filename'])
+    product_inventory = _get_inventory()
+    inventoried = {product['filename'] for product in
+                   product_inventory.values()}
 
     # any left over files in other_files will be un-inventorised processed
     # files and a user warning should be raised.
-    if len(other_files) != 0:
+    if other_files - inventoried:
         warnings.warn("Any manually added processed files must be explicitly"
                       " added to the product inventory using the"
                       " gs_localmanager.add_new_products function.")
 
-    for uuid in product_inventory_gone:  # now holds inventory entries for
-        product_inventory.pop(uuid, None)  # product that no longer exist
+    # inventory entries for products that no longer exist
+    present = safe_products | other_files
+    _remove_products([uuid for uuid, product in product_inventory.items()
+                      if product['filename'] not in present])
+
+    product_list_add = sorted(safe_products - inventoried)
 
     new_products = {}
 
+    to_read = []
+
     for filename in product_list_add:
         print("Adding user added file {0} to product"
               " inventory.".format(filename))
@@ -155,60 +293,567 @@ def check_integrity():
                                " 'S1' or 'S2' and follow standard naming"
                                " conventions. \n See"
                                " https://scihub.copernicus.eu/userguide/")
-        hub = gs_downloader.CopernicusHubConnection()
-        product_name = filename[:-5]
-
         # skip all user produced files.
-        if 'USER_PRD' in product_name:
+        if 'USER_PRD' in filename:
             warnings.warn("Any manually added processed files must be"
                           " explicitly added to the product inventory using"
                           " the gs_localmanager.add_new_products function.")
             continue
+        to_read.append(filename)
+
+    # build the product info from the .SAFE metadata where possible
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        local_info = pool.map(
+            lambda filename: _read_safe_metadata(data_path.joinpath(filename)),
+            to_read)
+        local_info = dict(zip(to_read, local_info))
 
-        search_term = 'filename:*' + product_name + '*'
-        total, product = hub.raw_query(search_term)
-        if total is 1:  # matching ESA database product found
-            for uuid in product:
-                product_info = product[uuid]
+    unread = []
+    for filename in to_read:
+        if local_info[filename] is None:
+            unread.append(filename)
+            continue
+        product_info = local_info[filename]
+        new_products[product_info['origin']] = product_info
 
-        if total > 1 or total is 0:
-            # couldn't find a unique product.
-            # this should almost never be != 1 unless someone has explicitly
-            # changed the file name of their manually added product
-            raise RuntimeError("Could not find a unique matching product"
-                               " in the ESA database for filename: \n"
-                               " {0} in the {1} directory."
-                               "".format(filename, config.DATA_PATH))
+    # otherwise fall back on the ESA database
+    if unread:
+        matches = _hub_lookup(unread)
+        for filename in unread:
+            if len(matches[filename]) != 1:
+                # couldn't find a unique product.
+                # this should almost never be != 1 unless someone has
+                # explicitly changed the file name of their manually added
+                # product
+                raise RuntimeError("Could not find a unique matching product"
+                                   " in the ESA database for filename: \n"
+                                   " {0} in the {1} directory."
+                                   "".format(filename, data_path))
+            new_products.update(matches[filename])
 
-        new_products[uuid] = product_info
+    _upsert_products(new_products)
 
-    for uuid in new_products:
-        product_inventory[uuid] = new_products[uuid]
+    _set_meta({'scan_mtime': scan_mtime,
+               'scan_time': scan_time,
+               'scan_version': _get_version(),
+               'scan_entries': entries})
 
-    _save_product_inventory(product_inventory)
 
-    return True
+def _hub_lookup(filenames, max_workers=4):
+    """Looks up product info in the ESA database for a list of filenames.
+
+    The filenames are combined into OR-joined queries, kept within the batch
+    size and URL length limits, which are run concurrently. Returns a dict of
+    the matching products, keyed by UUID, for each filename.
+    """
+
+    batches = []
+    batch = []
+    length = 0
+    for filename in filenames:
+        term = 'filename:' + filename[:-5] + '*'
+        if batch and (len(batch) == HUB_BATCH_SIZE or
+                      length + len(term) > HUB_MAX_QUERY_LENGTH):
+            batches.append(batch)
+            batch = []
+            length = 0
+        batch.append(term)
+        length = length + len(term) + len(' OR ')
+    if batch:
+        batches.append(batch)
+
+    hub = gs_downloader.CopernicusHubConnection()
+
+    def query(batch):
+        total, products = hub.raw_query('(' + ' OR '.join(batch) + ')',
+                                        rows=100)
+        return products
+
+    matches = {filename: {} for filename in filenames}
+    by_name = {filename[:-5]: filename for filename in filenames}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        for products in pool.map(query, batches):
+            for uuid, product in products.items():
+                filename = by_name.get(product['filename'].split('.')[0])
+                if filename is not None:
+                    matches[filename][uuid] = product
+
+    return matches
+
+
+def _read_safe_metadata(safe_path):
+    """Builds the product info of a .SAFE product from its metadata files.
+
+    Sentinel-2 products are read from their MTD_MSIL1C.xml or MTD_MSIL2A.xml
+    file, Sentinel-1 products from their manifest.safe and annotation files.
+    Returns None if the metadata cannot be found or read.
+    """
+
+    identifier = safe_path.name[:-5]
+    try:
+        if identifier.startswith('S2'):
+            product = _read_s2_metadata(safe_path)
+        else:
+            product = _read_s1_metadata(safe_path)
+    except (OSError, ET.ParseError, KeyError, IndexError, ValueError):
+        return None
+    if product is None:
+        return None
+
+    # leave out any fields missing from the metadata
+    product = {key: value for key, value in product.items()
+               if value is not None}
+    uuid = str(uuidlib.uuid5(uuidlib.NAMESPACE_URL, identifier))
+    product.update({'filename': safe_path.name,
+                    'identifier': identifier,
+                    'format': 'SAFE',
+                    'origin': uuid,
+                    'userprocessed': False,
+                    'localmetadata': True})
+
+    return product
+
+
+def _read_s2_metadata(safe_path):
+    """Reads the product info from a Sentinel-2 MTD_MSIL*.xml file."""
+
+    metadata_files = list(safe_path.glob('MTD_MSIL*.xml'))
+    if len(metadata_files) != 1:
+        return None
+
+    values = _xml_values(metadata_files[0])
+    # lat lon pairs of the product footprint
+    positions = values['EXT_POS_LIST'].split()
+    points = [(positions[i + 1], positions[i])
+              for i in range(0, len(positions) - 1, 2)]
+    # the tile ID is only given in the product name, e.g. _T32ULE_
+    tiles = [x[1:] for x in safe_path.name.split('_')
+             if len(x) == 6 and x.startswith('T')]
+
+    product = {'beginposition': _hub_time(values['PRODUCT_START_TIME']),
+               'endposition': _hub_time(values['PRODUCT_STOP_TIME']),
+               'footprint': _wkt_polygon(points),
+               'platformname': 'Sentinel-2',
+               'processinglevel': values['PROCESSING_LEVEL'],
+               'producttype': values['PRODUCT_TYPE'],
+               'processingbaseline': values.get('PROCESSING_BASELINE'),
+               'orbitdirection': values.get('SENSING_ORBIT_DIRECTION'),
+               'relativeorbitnumber': values.get('SENSING_ORBIT_NUMBER'),
+               'cloudcoverpercentage': values.get(
+                   'Cloud_Coverage_Assessment')}
+    if tiles:
+        product['tileid'] = tiles[0]
+
+    return product
+
+
+def _read_s1_metadata(safe_path):
+    """Reads the product info from a Sentinel-1 manifest.safe file."""
+
+    values = _xml_values(safe_path.joinpath('manifest.safe'),
+                         repeated=['transmitterReceiverPolarisation'])
+    # lat,lon pairs of the product footprint
+    points = [tuple(reversed(point.split(',')))
+              for point in values['coordinates'].split()]
+
+    polarisations = values.get('transmitterReceiverPolarisation')
+    if not polarisations:
+        # annotation files are named e.g. s1a-iw-grd-vv-...xml
+        annotations = safe_path.joinpath('annotation').glob('*.xml')
+        polarisations = sorted({x.name.split('-')[3].upper()
+                                for x in annotations}, reverse=True)
+
+    product = {'beginposition': _hub_time(values['startTime']),
+               'endposition': _hub_time(values['stopTime']),
+               'footprint': _wkt_polygon(points),
+               'platformname': 'Sentinel-1',
+               'producttype': values['productType'],
+               'productclass': values.get('productClass'),
+               'polarisationmode': ' '.join(polarisations),
+               'sensoroperationalmode': values.get('mode'),
+               'orbitdirection': values.get('pass'),
+               'orbitnumber': values.get('orbitNumber'),
+               'relativeorbitnumber': values.get('relativeOrbitNumber'),
+               'missiondatatakeid': values.get('missionDataTakeID'),
+               'slicenumber': values.get('sliceNumber')}
+
+    return product
+
+
+def _xml_values(xml_path, repeated=[]):
+    """Returns the text of the first element with each tag name in an XML
+    file, ignoring namespaces. Tags in `repeated` are returned as lists of
+    the text of every such element."""
+
+    values = {tag: [] for tag in repeated}
+
+    for element in ET.parse(str(xml_path)).iter():
+        tag = element.tag.split('}')[-1]
+        text = (element.text or '').strip()
+        if not text:
+            continue
+        if tag in values and tag in repeated:
+            values[tag].append(text)
+        elif tag not in values:
+            values[tag] = text
+
+    return values
+
+
+def _hub_time(timestring):
+    """Formats a metadata timestamp like the ESA hub, e.g.
+    '2015-08-24T06:22:07.950000' becomes '2015-08-24T06:22:07.950Z'."""
+
+    timestring = timestring.rstrip('Z')
+    if '.' not in timestring:
+        return timestring + '.000Z'
+    seconds, fraction = timestring.split('.')
+
+    return '{0}.{1}Z'.format(seconds, fraction[:3].ljust(3, '0'))
+
+
+def _wkt_polygon(points):
+    """Formats a list of (lon, lat) strings as a closed WKT polygon."""
+
+    if points[0] != points[-1]:
+        points = points + [points[0]]
+
+    return 'POLYGON (({0}))'.format(
+        ','.join('{0} {1}'.format(lon, lat) for lon, lat in points))
+
+
+def _connect():
+    """Opens the product inventory database, creating it if needed.
+
+    The schema is set up and earlier inventories are migrated once per
+    process and database, or again if the database has been removed.
+    """
+
+    config = UserConfig()
+    data_path = Path(config.DATA_PATH)
+    db_path = data_path.joinpath(DB_DIR, INVENTORY_DB)
+    if not db_path.exists():
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        _move_legacy_database(data_path, db_path)
+    elif str(db_path.resolve()) in _schema_ready:
+        return sqlite3.connect(str(db_path), timeout=DB_TIMEOUT)
+
+    connection = sqlite3.connect(str(db_path), timeout=DB_TIMEOUT)
+    if config.INVENTORY_JOURNAL == 'wal':
+        connection.execute('PRAGMA journal_mode=WAL')
+    with connection:
+        connection.execute('CREATE TABLE IF NOT EXISTS products ('
+                           ' uuid TEXT PRIMARY KEY,'
+                           ' info TEXT NOT NULL)')
+        connection.execute('CREATE TABLE IF NOT EXISTS meta ('
+                           ' key TEXT PRIMARY KEY,'
+                           ' value TEXT NOT NULL)')
+        # last use and size on disk of products, for evict_products
+        connection.execute('CREATE TABLE IF NOT EXISTS usage ('
+                           ' uuid TEXT PRIMARY KEY,'
+                           ' accessed REAL NOT NULL,'
+                           ' size INTEGER)')
+    _migrate_json_inventory(connection, data_path)
+    _create_footprint_index(connection)
+    _normalise_footprint_dates(connection)
+    _create_change_log(connection)
+    # the setup is idempotent, so threads racing to do it are harmless
+    _schema_ready.add(str(db_path.resolve()))
+
+    return connection
+
+
+def _move_legacy_database(data_path, db_path):
+    """Moves a database kept in the DATA_PATH itself by earlier versions,
+    along with its journal files, to db_path."""
+
+    legacy_path = data_path.joinpath(INVENTORY_DB)
+    if not legacy_path.exists():
+        return
+
+    with inventory_lock():
+        if db_path.exists():  # moved by another process meanwhile
+            return
+        # the database last, so that it is only found with its journal
+        for suffix in DB_FILE_SUFFIXES[::-1]:
+            source = Path(str(legacy_path) + suffix)
+            if source.exists():
+                source.replace(Path(str(db_path) + suffix))
+
+
+def _create_change_log(connection):
+    """Creates the log of inventory changes if it does not exist, logging
+    the products already in the inventory as added."""
+
+    exists = connection.execute("SELECT 1 FROM sqlite_master WHERE"
+                                " name = 'changes'").fetchone()
+    if exists:
+        return
+
+    with connection:
+        connection.execute('CREATE TABLE changes ('
+                           ' seq INTEGER PRIMARY KEY AUTOINCREMENT,'
+                           ' time REAL NOT NULL,'
+                           ' event TEXT NOT NULL,'
+                           ' uuid TEXT NOT NULL)')
+        rows = connection.execute('SELECT uuid, info FROM products'
+                                  ' ORDER BY rowid')
+        _log_changes(connection, [(_change_event(json.loads(info), False),
+                                   uuid) for uuid, info in rows])
+
+
+def _log_changes(connection, events):
+    """Appends (event, uuid) pairs to the change log within the current
+    transaction."""
+
+    now = time.time()
+    connection.executemany('INSERT INTO changes (time, event, uuid)'
+                           ' VALUES (?, ?, ?)',
+                           [(now, event, uuid) for event, uuid in events])
+
+
+def _change_event(product, replaced):
+    """Returns the change log event for storing a product."""
+
+    if replaced:
+        return 'update'
+    if product.get('userprocessed'):
+        return 'process'
+    return 'add'
+
+
+def _create_footprint_index(connection):
+    """Creates the spatial index of product footprints if it does not exist,
+    indexing any products already in the inventory."""
+
+    exists = connection.execute("SELECT 1 FROM sqlite_master WHERE"
+                                " name = 'footprints'").fetchone()
+    if exists:
+        return
+
+    with connection:
+        connection.execute('CREATE TABLE footprints ('
+                           ' id INTEGER PRIMARY KEY,'
+                           ' uuid TEXT UNIQUE NOT NULL,'
+                           ' begin TEXT,'
+                           ' wkb BLOB NOT NULL)')
+        try:
+            connection.execute('CREATE VIRTUAL TABLE footprint_index USING'
+                               ' rtree(id, minx, maxx, miny, maxy)')
+        except sqlite3.OperationalError:
+            # SQLite built without the R*Tree module, use a plain table
+            connection.execute('CREATE TABLE footprint_index ('
+                               ' id INTEGER PRIMARY KEY,'
+                               ' minx REAL, maxx REAL, miny REAL, maxy REAL)')
+        rows = connection.execute('SELECT uuid, info FROM products')
+        _index_footprints(connection, {uuid: json.loads(info)
+                                       for uuid, info in rows})
+
+
+def _normalise_footprint_dates(connection):
+    """Converts sensing start times stored by earlier versions, with their
+    'Z' suffix, to the date index format, see `_index_date`."""
+
+    legacy = connection.execute("SELECT 1 FROM footprints"
+                                " WHERE begin LIKE '%Z' LIMIT 1").fetchone()
+    if legacy is None:
+        return
+
+    with connection:
+        connection.execute("UPDATE footprints SET begin = rtrim(begin, 'Z')"
+                           " WHERE begin LIKE '%Z'")
+
+
+def _index_footprints(connection, products):
+    """Stores the footprints of products as WKB in the spatial index."""
+
+    _unindex_footprints(connection, products.keys())
+
+    for uuid, product in products.items():
+        footprint = as_product(product).shape
+        if footprint is None:
+            continue  # no usable footprint
+        cursor = connection.execute(
+            'INSERT INTO footprints (uuid, begin, wkb) VALUES (?, ?, ?)',
+            (uuid, _index_date(product), footprint.wkb))
+        minx, miny, maxx, maxy = footprint.bounds
+        connection.execute(
+            'INSERT INTO footprint_index VALUES (?, ?, ?, ?, ?)',
+            (cursor.lastrowid, minx, maxx, miny, maxy))
+
+
+def _unindex_footprints(connection, uuids):
+    """Removes the footprints of products from the spatial index."""
+
+    for uuid in uuids:
+        row = connection.execute('SELECT id FROM footprints WHERE uuid = ?',
+                                 (uuid,)).fetchone()
+        if row is None:
+            continue
+        connection.execute('DELETE FROM footprint_index WHERE id = ?', row)
+        connection.execute('DELETE FROM footprints WHERE id = ?', row)
+
+
+def _migrate_json_inventory(connection, data_path):
+    """Moves the products of a legacy product_inventory.json into the
+    database. The .json file is kept, renamed, as a backup."""
+
+    json_path = data_path.joinpath(INVENTORY_JSON)
+    if not json_path.exists():
+        return
+
+    with inventory_lock():
+        if not json_path.exists():  # migrated by another process meanwhile
+            return
+        try:
+            with json_path.open() as read_in:
+                product_inventory = json.load(read_in)
+        except (ValueError, TypeError):
+            if json_path.stat().st_size:
+                # a partially written inventory, keep it for manual recovery
+                warnings.warn("{0} is corrupted and has not been migrated. It"
+                              " is kept as product_inventory.corrupt.json."
+                              "".format(json_path))
+                json_path.replace(
+                    data_path.joinpath('product_inventory.corrupt.json'))
+                return
+            product_inventory = {}  # if the inventory is empty
+
+        print("Migrating {0} products from {1} to {2}.".format(
+            len(product_inventory), INVENTORY_JSON, INVENTORY_DB))
+        with connection:
+            # products already in the database take precedence
+            connection.executemany(
+                'INSERT OR IGNORE INTO products VALUES (?, ?)',
+                [(uuid, json.dumps(product)) for uuid, product
+                 in product_inventory.items()])
+        json_path.replace(
+            data_path.joinpath('product_inventory.migrated.json'))
 
 
 def _get_inventory():
-    """"Retrieves the product inventory from .json file."""
+    """"Retrieves the product inventory from the database.
+
+    The inventory is cached in-process and only re-read once the inventory
+    version has changed, i.e. after a write by this or another process. The
+    returned dict is shared and must not be modified.
+    """
+
+    return _get_cache_entry()[1]
+
+
+def _get_cache_entry():
+    """Returns the cache entry (key, inventory, index) of the current
+    inventory version, loading the inventory if needed."""
 
     config = UserConfig()
-    product_inventory_path = Path(config.DATA_PATH).joinpath(
-        'product_inventory.json')
-    product_inventory_path.touch(exist_ok=True)
-    try:
-        with product_inventory_path.open() as read_in:
-            product_inventory = json.load(read_in)
-    except (ValueError, TypeError):  # if the inventory is empty
-        product_inventory = {}
+    data_path = str(Path(config.DATA_PATH).resolve())
+    key = (data_path, _get_version())
+    with _cache_lock:
+        entry = _inventory_cache.get('entry')
+    if entry is not None and entry[0] == key:
+        return entry
 
-    return product_inventory
+    with closing(_connect()) as connection:
+        # read the version and the rows in one transaction so they match
+        connection.execute('BEGIN')
+        try:
+            version = _read_version(connection)
+            rows = connection.execute('SELECT uuid, info FROM products')
+            product_inventory = {uuid: Product(json.loads(info))
+                                 for uuid, info in rows}
+        finally:
+            connection.rollback()
+
+    key = (data_path, version)
+    entry = (key, product_inventory, None)  # index built by _get_index
+    with _cache_lock:
+        current = _inventory_cache.get('entry')
+        # keep an entry of the same or a newer version published meanwhile
+        if (current is None or current[0][0] != data_path or
+                current[0][1] < key[1]):
+            _inventory_cache['entry'] = entry
+        elif current[0] == key:
+            entry = current
+
+    return entry
+
+
+def _get_products(uuids):
+    """Retrieves the given products from the database, if present."""
+
+    uuids = list(uuids)
+    products = {}
+
+    with closing(_connect()) as connection:
+        # stay well within the SQLite limit on query parameters
+        for i in range(0, len(uuids), 500):
+            batch = uuids[i:i + 500]
+            rows = connection.execute(
+                'SELECT uuid, info FROM products WHERE uuid IN ({0})'.format(
+                    ', '.join('?' * len(batch))), batch)
+            products.update({uuid: json.loads(info) for uuid, info in rows})
+
+    return products
 
 
-def get_product_inventory():
+def _get_meta(keys):
+    """Retrieves inventory metadata values, None where not set."""
+
+    values = {key: None for key in keys}
+
+    with closing(_connect()) as connection:
+        rows = connection.execute(
+            'SELECT key, value FROM meta WHERE key IN ({0})'.format(
+                ', '.join('?' * len(keys))), keys)
+        values.update({key: json.loads(value) for key, value in rows})
+
+    return values
+
+
+def _set_meta(values):
+    """Stores inventory metadata values."""
+
+    with closing(_connect()) as connection:
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                [(key, json.dumps(value)) for key, value in values.items()])
+
+
+def _get_version():
+    """Returns the inventory version, incremented on every change."""
+
+    return _get_meta(['version'])['version'] or 0
+
+
+def _read_version(connection):
+    """Returns the inventory version within the current transaction."""
+
+    row = connection.execute(
+        "SELECT value FROM meta WHERE key = 'version'").fetchone()
+
+    return json.loads(row[0]) if row else 0
+
+
+def _bump_version(connection):
+    """Increments the inventory version within the current transaction."""
+
+    connection.execute("INSERT OR IGNORE INTO meta VALUES ('version', '0')")
+    connection.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1"
+                       " WHERE key = 'version'")
+
+
+def get_product_inventory(trust_cache=False):
     """Returns the product inventory as a dictionary keyed by product UUIDs.
 
+    Parameters
+    ----------
+    trust_cache : bool, optional
+        Passed to `check_integrity`. If True, a cached integrity check is
+        trusted without inspecting the DATA_PATH.
+
     Returns
     -------
     product_inventory : dict
@@ -217,22 +862,497 @@ def get_product_inventory():
 
     """
 
-    check_integrity()
+    check_integrity(trust_cache)
 
-    product_inventory = _get_inventory()
+    # copy the products so that callers cannot modify the cached inventory
+    product_inventory = {uuid: product.copy() for uuid, product in
+                         _get_inventory().items()}
 
     return product_inventory
 
 
-def _save_product_inventory(product_inventory):
-    """Writes the updated product inventory to the associated .json file."""
+def get_product(uuid, trust_cache=False):
+    """Returns the info of a single product in the inventory.
+
+    Parameters
+    ----------
+    uuid : str
+        UUID of the product.
+    trust_cache : bool, optional
+        Passed to `check_integrity`. If True, a cached integrity check is
+        trusted without inspecting the DATA_PATH.
+
+    Returns
+    -------
+    dict
+        The product info.
+
+    Raises
+    ------
+    KeyError
+        If the product is not in the inventory.
+
+    """
+
+    check_integrity(trust_cache)
+
+    return _get_inventory()[uuid].copy()
+
+
+def find(platform=None, tile=None, start=None, end=None, level=None,
+         userprocessed=None, trust_cache=False):
+    """Returns the inventory products matching all of the given criteria.
+
+    Lookups use secondary indexes on the in-process inventory cache: hash
+    indexes on platform, tile, level and processed state and a sorted array
+    of sensing start times. The indexes are updated on writes by this process
+    and rebuilt after writes by other processes.
+
+    Parameters
+    ----------
+    platform : str, optional
+        'Sentinel-1' or 'Sentinel-2', or the short forms 'S1' or 'S2'.
+    tile : str, optional
+        Sentinel-2 MGRS tile ID, e.g. '32ULE'.
+    start : datetime.date or datetime.datetime, optional
+        Earliest sensing start time.
+    end : datetime.date or datetime.datetime, optional
+        Latest sensing start time. A `datetime.date` is inclusive of the day.
+    level : str, optional
+        Processing level, e.g. 'L1C', 'Level-2A', '2A' or 'L1'.
+    userprocessed : bool, optional
+        Whether the products were processed by the user.
+    trust_cache : bool, optional
+        Passed to `check_integrity`. If True, a cached integrity check is
+        trusted without inspecting the DATA_PATH.
+
+    Returns
+    -------
+    dict
+        Matching products keyed by their UUIDs, in order of sensing time.
+
+    """
+
+    check_integrity(trust_cache)
+
+    product_inventory, index = _get_index()
+
+    if platform in ['S1', 'S2']:
+        platform = 'Sentinel-' + platform[1]
+    if level:
+        level = _normalise_level(level)
+
+    matches = []
+    for name, value in [('platform', platform), ('tile', tile),
+                        ('level', level), ('userprocessed', userprocessed)]:
+        if value is not None:
+            matches.append(index[name].get(value, set()))
+
+    matches.sort(key=len)
+
+    if start is not None or end is not None:
+        dates, uuids = index['dates']
+        first, last, last_included = _date_bounds(start, end)
+        lower = 0
+        upper = len(dates)
+        if first is not None:
+            lower = bisect.bisect_left(dates, first)
+        if last is not None:
+            if last_included:
+                upper = bisect.bisect_right(dates, last)
+            else:
+                upper = bisect.bisect_left(dates, last)
+        # the date slice is already in order of sensing time
+        found = uuids[lower:upper]
+        for match in matches:
+            found = [uuid for uuid in found if uuid in match]
+    else:
+        if matches:
+            found = matches[0].intersection(*matches[1:])
+        else:
+            found = product_inventory.keys()
+        position = index['position']
+        found = sorted(found, key=lambda uuid: position.get(uuid, -1))
+
+    return {uuid: product_inventory[uuid].copy() for uuid in found}
+
+
+def products_intersecting(roi, start=None, end=None, trust_cache=False):
+    """Returns the inventory products whose footprints intersect an ROI.
+
+    Candidates are selected by bounding box from a persisted R-tree of the
+    product footprints and then tested exactly against the ROI using the
+    footprints stored as WKB, so no footprint WKT is parsed.
+
+    Parameters
+    ----------
+    roi : shapely.geometry.base.BaseGeometry
+        The region of interest in WGS84, e.g. `gs_downloader.Query.ROI`.
+    start : datetime.date or datetime.datetime, optional
+        Earliest sensing start time.
+    end : datetime.date or datetime.datetime, optional
+        Latest sensing start time. A `datetime.date` is inclusive of the day.
+    trust_cache : bool, optional
+        Passed to `check_integrity`. If True, a cached integrity check is
+        trusted without inspecting the DATA_PATH.
+
+    Returns
+    -------
+    dict
+        Matching products keyed by their UUIDs, in order of sensing time.
+
+    """
+
+    check_integrity(trust_cache)
+
+    minx, miny, maxx, maxy = roi.bounds
+    query = ('SELECT f.uuid, f.wkb FROM footprint_index AS i'
+             ' JOIN footprints AS f ON f.id = i.id'
+             ' WHERE i.maxx >= ? AND i.minx <= ?'
+             ' AND i.maxy >= ? AND i.miny <= ?')
+    params = [minx, maxx, miny, maxy]
+    first, last, last_included = _date_bounds(start, end)
+    if first is not None:
+        query = query + ' AND f.begin >= ?'
+        params.append(first)
+    if last is not None:
+        query = query + (' AND f.begin <= ?' if last_included
+                         else ' AND f.begin < ?')
+        params.append(last)
+    query = query + ' ORDER BY f.begin'
+
+    prepared_roi = prep(roi)
+    with closing(_connect()) as connection:
+        matches = [uuid for uuid, footprint in connection.execute(query,
+                                                                  params)
+                   if prepared_roi.intersects(wkb.loads(bytes(footprint)))]
+
+    product_inventory = _get_inventory()
+
+    return {uuid: product_inventory[uuid].copy() for uuid in matches
+            if uuid in product_inventory}
+
+
+def find_derived(origin, processor=None, config_hash=None,
+                 trust_cache=False):
+    """Returns the processed products derived from a product.
+
+    Processed products are indexed by the UUID of the product they were
+    processed from, the processor used and the hash of its configuration, as
+    recorded by `gs_processor`.
+
+    Parameters
+    ----------
+    origin : str
+        UUID of the product that was processed.
+    processor : str, optional
+        The processor used, 'sen2cor' or 'gpt'.
+    config_hash : str, optional
+        Hash of the processor configuration, see `gs_processor.config_hash`.
+    trust_cache : bool, optional
+        Passed to `check_integrity`. If True, a cached integrity check is
+        trusted without inspecting the DATA_PATH.
+
+    Returns
+    -------
+    dict
+        Matching products keyed by their UUIDs, in the order they were
+        processed, i.e. the most recent last.
+
+    """
+
+    check_integrity(trust_cache)
+
+    product_inventory, index = _get_index()
+
+    found = []
+    for uuid in index['lineage'].get(origin, []):
+        product = product_inventory[uuid]
+        if processor is not None and product.get('processor') != processor:
+            continue
+        if (config_hash is not None and
+                product.get('processhash') != config_hash):
+            continue
+        found.append(uuid)
+
+    # products processed by earlier versions have no processing time, these
+    # are ordered by their last logged change
+    untimed = [uuid for uuid in found
+               if not product_inventory[uuid].get('processed')]
+    last_changes = _last_changes(untimed) if untimed else {}
+    found.sort(key=lambda uuid: (product_inventory[uuid].get('processed', ''),
+                                 last_changes.get(uuid, 0), uuid))
+
+    return {uuid: product_inventory[uuid].copy() for uuid in found}
+
+
+def _last_changes(uuids):
+    """Returns the sequence numbers of the last logged changes of products
+    keyed by their UUIDs."""
+
+    uuids = list(uuids)
+    last_changes = {}
+
+    with closing(_connect()) as connection:
+        # stay well within the SQLite limit on query parameters
+        for i in range(0, len(uuids), 500):
+            batch = uuids[i:i + 500]
+            rows = connection.execute(
+                'SELECT uuid, MAX(seq) FROM changes WHERE uuid IN ({0})'
+                ' GROUP BY uuid'.format(', '.join('?' * len(batch))), batch)
+            last_changes.update(rows)
+
+    return last_changes
+
+
+def _get_index():
+    """Returns the cached inventory and its secondary indexes, built from
+    that inventory."""
+
+    entry = _get_cache_entry()
+    key, product_inventory, index = entry
+    if index is not None:
+        return product_inventory, index
+
+    index = {name: {} for name in INDEXES}
+    dated = []
+
+    for uuid, product in product_inventory.items():
+        for name, values in _index_keys(product).items():
+            for value in values:
+                index[name].setdefault(value, set()).add(uuid)
+        date = _index_date(product)
+        if date:
+            dated.append((date, uuid))
+
+    dated.sort()
+    index['dates'] = ([date for date, _ in dated], [uuid for _, uuid in dated])
+    index['position'] = {uuid: i for i, (_, uuid) in enumerate(dated)}
+
+    with _cache_lock:
+        # only if the cached inventory is still the one indexed
+        if _inventory_cache.get('entry') is entry:
+            _inventory_cache['entry'] = (key, product_inventory, index)
+
+    return product_inventory, index
+
+
+def _index_keys(product):
+    """Returns the values under which a product is found in each of the
+    hash indexes."""
+
+    keys = {'platform': [product.get('platformname')],
+            'tile': _product_tiles(product),
+            'level': [_product_level(product)],
+            'userprocessed': [bool(product.get('userprocessed'))],
+            'lineage': [product.get('origin') if
+                        product.get('userprocessed') else None]}
+
+    return {name: [value for value in values if value is not None]
+            for name, values in keys.items()}
+
+
+def _index_date(product):
+    """Returns the sensing start time of a product in the date index, None
+    if not known."""
+
+    # ISO 8601 timestamps sort chronologically as strings
+    return (product.get('beginposition') or '').rstrip('Z') or None
+
+
+def _date_bounds(start, end):
+    """Returns the first and last sensing start time in the date index
+    format of a `find` date range, None where open, and whether the last is
+    included. A `datetime.date` end is inclusive of the day."""
+
+    first = None if start is None else start.isoformat()
+    if end is None:
+        return first, None, True
+    if type(end) is datetime.date:
+        return first, (end + datetime.timedelta(days=1)).isoformat(), False
+    return first, end.isoformat(), True
+
+
+def _update_index(index, product_inventory, changes):
+    """Returns a copy of the indexes of product_inventory with the changed
+    products, None where removed, applied. Unchanged parts are shared."""
+
+    updated = {name: dict(index[name]) for name in INDEXES}
+    copied = set()
+    dates, uuids = list(index['dates'][0]), list(index['dates'][1])
+
+    def members(name, value):
+        # copy each set before its first change, readers may hold the old one
+        if (name, value) not in copied:
+            updated[name][value] = set(updated[name].get(value, ()))
+            copied.add((name, value))
+        return updated[name][value]
+
+    def date_position(date, uuid):
+        # entries of the same date are in order of UUID, as when built
+        lower = bisect.bisect_left(dates, date)
+        upper = bisect.bisect_right(dates, date, lower)
+        return bisect.bisect_left(uuids, uuid, lower, upper)
+
+    for uuid, product in changes.items():
+        old = product_inventory.get(uuid)
+        if old is not None:
+            for name, values in _index_keys(old).items():
+                for value in values:
+                    members(name, value).discard(uuid)
+            date = _index_date(old)
+            if date:
+                position = date_position(date, uuid)
+                del dates[position], uuids[position]
+        if product is not None:
+            for name, values in _index_keys(product).items():
+                for value in values:
+                    members(name, value).add(uuid)
+            date = _index_date(product)
+            if date:
+                position = date_position(date, uuid)
+                dates.insert(position, date)
+                uuids.insert(position, uuid)
+
+    updated['dates'] = (dates, uuids)
+    updated['position'] = {uuid: i for i, uuid in enumerate(uuids)}
+
+    return updated
+
+
+def _apply_to_cache(version, changes):
+    """Applies a write of this process, which moved the inventory to
+    version, to the cached inventory and indexes.
+
+    changes holds the JSON info of the products written, None where
+    removed. The cache is dropped if it does not hold the previous version,
+    e.g. after a write by another process.
+    """
 
     config = UserConfig()
-    product_inventory_path = Path(config.DATA_PATH).joinpath(
-        'product_inventory.json')
-    product_inventory_path.touch(exist_ok=True)
-    with product_inventory_path.open(mode='w') as write_out:
-        json.dump(product_inventory, write_out)
+    data_path = str(Path(config.DATA_PATH).resolve())
+
+    with _cache_lock:
+        entry = _inventory_cache.get('entry')
+        if entry is None or entry[0] == (data_path, version):
+            return  # nothing cached, or already read back
+        if entry[0] != (data_path, version - 1):
+            _inventory_cache.clear()
+            return
+
+        _, product_inventory, index = entry
+        products = {uuid: None if info is None else Product(json.loads(info))
+                    for uuid, info in changes.items()}
+        # a new dict, readers may be iterating the old one
+        updated = dict(product_inventory)
+        for uuid, product in products.items():
+            if product is None:
+                updated.pop(uuid, None)
+            else:
+                updated[uuid] = product
+        if index is not None:
+            index = _update_index(index, product_inventory, products)
+
+        _inventory_cache['entry'] = ((data_path, version), updated, index)
+
+
+def _product_tiles(product):
+    """Returns the list of tile IDs of a product."""
+
+    tiles = product.get('tileid')
+    if not tiles:
+        return []
+    if isinstance(tiles, str):
+        return [tiles]
+    # older inventories hold nested lists of tiles
+    flat = []
+    for tile in tiles:
+        flat.extend(_product_tiles({'tileid': tile}))
+
+    return flat
+
+
+def _product_level(product):
+    """Returns the processing level of a product, e.g. 'L1C' or 'L1'."""
+
+    level = product.get('processinglevel')
+    if level:
+        return _normalise_level(level)
+    # e.g. S1A_IW_GRDH_1SDV_... is a level 1 product
+    parts = product.get('identifier', '').split('_')
+    if parts[0].startswith('S1') and len(parts) > 3 and parts[3][0].isdigit():
+        return 'L' + parts[3][0]
+
+    return None
+
+
+def _normalise_level(level):
+    """Returns a processing level such as 'Level-1C', 'L1C' or '1C' as
+    'L1C'."""
+
+    level = level.upper().replace('LEVEL-', '')
+    if not level.startswith('L'):
+        level = 'L' + level
+
+    return level
+
+
+def _upsert_products(products):
+    """Inserts or replaces products in the database in one transaction."""
+
+    if not products:
+        return
+
+    uuids = list(products.keys())
+    infos = {uuid: json.dumps(product) for uuid, product in products.items()}
+
+    with closing(_connect()) as connection:
+        with connection:
+            replaced = set()
+            for i in range(0, len(uuids), 500):
+                batch = uuids[i:i + 500]
+                rows = connection.execute(
+                    'SELECT uuid FROM products WHERE uuid IN ({0})'.format(
+                        ', '.join('?' * len(batch))), batch)
+                replaced.update(uuid for uuid, in rows)
+            connection.executemany(
+                'INSERT OR REPLACE INTO products VALUES (?, ?)',
+                list(infos.items()))
+            _log_changes(connection, [(_change_event(product,
+                                                     uuid in replaced), uuid)
+                                      for uuid, product in products.items()])
+            _index_footprints(connection, products)
+            # new products count as used, their size is measured on eviction
+            now = time.time()
+            connection.executemany(
+                'INSERT OR REPLACE INTO usage VALUES (?, ?, NULL)',
+                [(uuid, now) for uuid in products])
+            _bump_version(connection)
+            # the write lock is held, so this write made the version
+            version = _read_version(connection)
+
+    _apply_to_cache(version, infos)
+
+
+def _remove_products(uuids):
+    """Removes products from the database in one transaction."""
+
+    if not uuids:
+        return
+
+    with closing(_connect()) as connection:
+        with connection:
+            connection.executemany('DELETE FROM products WHERE uuid = ?',
+                                   [(uuid,) for uuid in uuids])
+            _unindex_footprints(connection, uuids)
+            connection.executemany('DELETE FROM usage WHERE uuid = ?',
+                                   [(uuid,) for uuid in uuids])
+            _log_changes(connection, [('remove', uuid) for uuid in uuids])
+            _bump_version(connection)
+            # the write lock is held, so this write made the version
+            version = _read_version(connection)
+
+    _apply_to_cache(version, dict.fromkeys(uuids))
 
 
 def add_new_products(new_products: dict):
@@ -253,26 +1373,550 @@ def add_new_products(new_products: dict):
 
     """
 
+    with inventory_lock():
+        product_inventory = _get_products(new_products.keys())
+        added_uuids = []
+        added_products = {}
+
+        for uuid in new_products:
+            new_uuid = uuid
+            if new_uuid in product_inventory:
+                if product_inventory[uuid] == new_products[uuid]:
+                    print("Product {0} with UUID {1} is already"
+                          " present in the product inventory."
+                          " - Skipping"
+                          "".format(new_products[uuid]['identifier'],
+                                    uuid))
+                    continue
+                else:
+                    # product is a processed file
+                    new_products[uuid]['origin'] = uuid
+                new_uuid = _derived_uuid(uuid, new_products[uuid]['filename'],
+                                         added_products)
+            added_products[new_uuid] = new_products[uuid]
+            added_uuids.append(new_uuid)
+
+        _upsert_products(added_products)
+
+    return added_uuids
+
+
+def _derived_uuid(uuid, filename, added_products):
+    """Returns the UUID under which a product processed from uuid is stored.
+
+    This is the UUID of an inventoried product with the same file, which it
+    replaces, or else the first UUID in the `_get_new_uuid` sequence that is
+    not in use.
+    """
+
+    new_uuid = _get_new_uuid(uuid)
+    while True:
+        existing = added_products.get(new_uuid)
+        if existing is None:
+            existing = _get_products([new_uuid]).get(new_uuid)
+        if existing is None or existing['filename'] == filename:
+            return new_uuid
+        new_uuid = _get_new_uuid(new_uuid)
+
+
+def changes_since(seq=0, limit=None, trust_cache=False):
+    """Returns the inventory changes logged after a sequence number.
+
+    Every product added, processed, updated or removed is logged in order
+    with an increasing sequence number, so a consumer only has to pass the
+    sequence number of the last change it has seen to catch up. Products in
+    the inventory before the log existed are logged as added.
+
+    Parameters
+    ----------
+    seq : int, optional
+        Sequence number of the last change already seen. Default is 0, i.e.
+        all changes.
+    limit : int, optional
+        Maximum number of changes to return.
+    trust_cache : bool, optional
+        Passed to `check_integrity`. If True, a cached integrity check is
+        trusted without inspecting the DATA_PATH.
+
+    Returns
+    -------
+    list
+        The changes in order. Each change is a dict with the keys 'seq',
+        'time' (seconds since the epoch), 'event' ('add', 'process', 'update'
+        or 'remove'), 'uuid' and 'product', the product info if the product
+        is still in the inventory and None otherwise.
+
+    """
+
+    check_integrity(trust_cache)
+
+    query = ('SELECT seq, time, event, uuid FROM changes WHERE seq > ?'
+             ' ORDER BY seq')
+    params = [seq]
+    if limit is not None:
+        query = query + ' LIMIT ?'
+        params.append(limit)
+
+    with closing(_connect()) as connection:
+        rows = connection.execute(query, params).fetchall()
+
     product_inventory = _get_inventory()
-    added_uuids = []
-
-    for uuid in new_products:
-        new_uuid = uuid
-        if new_uuid in product_inventory:
-            if product_inventory[uuid] == new_products[uuid]:
-                print("Product {0} with UUID {1} is already"
-                      " present in the product inventory."
-                      " - Skipping"
-                      "".format(new_products[uuid]['identifier'],
-                                uuid))
+
+    changes = []
+    for seq, changed, event, uuid in rows:
+        product = product_inventory.get(uuid)
+        changes.append({'seq': seq,
+                        'time': changed,
+                        'event': event,
+                        'uuid': uuid,
+                        'product': None if product is None else
+                        product.copy()})
+
+    return changes
+
+
+def latest_change():
+    """Returns the sequence number of the latest logged inventory change,
+    0 if none.
+
+    Read it before `get_product_inventory` to start following the changes
+    from a snapshot of the inventory. Changes logged in between may then be
+    seen twice.
+    """
+
+    with closing(_connect()) as connection:
+        seq, = connection.execute('SELECT MAX(seq) FROM changes').fetchone()
+
+    return seq or 0
+
+
+def subscribe(seq=None, poll=5):
+    """Yields the inventory changes as they are logged, see
+    `changes_since`.
+
+    The change log is polled, and the DATA_PATH checked for manual changes,
+    every `poll` seconds while there are no new changes. The generator runs
+    until the consumer stops iterating.
+
+    Parameters
+    ----------
+    seq : int, optional
+        Sequence number of the last change already seen. By default only
+        changes logged from now on are yielded.
+    poll : float, optional
+        Seconds to wait between polls. Default is 5.
+
+    Yields
+    ------
+    dict
+        The next change.
+
+    """
+
+    if seq is None:
+        seq = latest_change()
+
+    while True:
+        changes = changes_since(seq)
+        for change in changes:
+            seq = change['seq']
+            yield change
+        if not changes:
+            time.sleep(poll)
+
+
+def touch_products(uuids):
+    """Records that products have just been used.
+
+    The least recently used products are the first to go when
+    `evict_products` makes room. `gs_processor` and `gs_stacker` record the
+    products they read and produce.
+
+    Parameters
+    ----------
+    uuids : list
+        UUIDs of the used products.
+
+    """
+
+    now = time.time()
+    uuids = list(uuids)
+
+    with closing(_connect()) as connection:
+        with connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO usage (uuid, accessed) VALUES (?, ?)',
+                [(uuid, now) for uuid in uuids])
+            connection.executemany(
+                'UPDATE usage SET accessed = ? WHERE uuid = ?',
+                [(now, uuid) for uuid in uuids])
+
+
+def evict_products(budget=None, processed=False, reserve=0, dry_run=False):
+    """Deletes the least recently used products until the inventoried
+    products fit within a size budget.
+
+    Raw products are evicted in order of their last use, as recorded by
+    `touch_products`. Processed products are kept unless `processed` is True,
+    in which case a raw product is evicted together with the products
+    processed from it and the group is ordered by its most recent use.
+    Processed products whose raw product has already gone are then evicted
+    on their own. The files and inventory entries are removed together.
+
+    Parameters
+    ----------
+    budget : int or str, optional
+        The size budget in bytes or as a string, e.g. '500 GB'. Defaults to
+        `data_budget` in the gs_config.json.
+    processed : bool, optional
+        If True, processed products may be evicted as well. Default is False.
+    reserve : int, optional
+        Bytes to free on top of the budget, e.g. for an upcoming download.
+    dry_run : bool, optional
+        If True, the products that would be evicted are returned but not
+        removed.
+
+    Returns
+    -------
+    dict
+        The evicted products keyed by their UUIDs.
+
+    Raises
+    ------
+    ValueError
+        If no budget is given or configured or it cannot be understood.
+
+    """
+
+    config = UserConfig()
+    if budget is None:
+        budget = config.DATA_BUDGET
+    if budget is None:
+        raise ValueError("No size budget given or set as data_budget in the"
+                         " gs_config.json.")
+    if isinstance(budget, str):
+        size = gs_downloader._parse_size(budget)
+        if not size:
+            raise ValueError("Could not understand the size budget {0},"
+                             " expected e.g. '500 GB'.".format(budget))
+        budget = size
+    limit = budget - reserve
+    data_path = Path(config.DATA_PATH)
+
+    with inventory_lock():
+        check_integrity()
+        product_inventory, index = _get_index()
+        usage = _get_usage(data_path, product_inventory)
+        total = sum(size for _, size in usage.values())
+        if total <= limit:
+            return {}
+
+        # group each raw product with everything processed from it
+        groups = []
+        grouped = set()
+        for uuid, product in product_inventory.items():
+            if product.get('userprocessed'):
                 continue
+            members = [uuid]
+            if processed:
+                pending = [uuid]
+                while pending:
+                    derived = index['lineage'].get(pending.pop(), set())
+                    derived = [x for x in derived if x not in members]
+                    members.extend(derived)
+                    pending.extend(derived)
+            grouped.update(members)
+            groups.append((max(usage[x][0] for x in members), members))
+        groups.sort()
+        if processed:
+            # processed products that have outlived their raw products
+            orphans = sorted((usage[uuid][0], [uuid]) for uuid in
+                             product_inventory if uuid not in grouped)
+            groups.extend(orphans)
+
+        evicted = {}
+        for _, members in groups:
+            if total <= limit:
+                break
+            for uuid in members:
+                evicted[uuid] = product_inventory[uuid].copy()
+                total = total - usage[uuid][1]
+
+        if dry_run:
+            return evicted
+
+        for uuid, product in evicted.items():
+            print("Evicting product {0}.".format(product['filename']))
+            product_path = data_path.joinpath(product['filename'])
+            if product_path.is_dir():
+                shutil.rmtree(str(product_path))
+            elif product_path.exists():
+                product_path.unlink()
+        _remove_products(list(evicted.keys()))
+
+    if total > limit:
+        warnings.warn("The inventoried products still take up {0} bytes, over"
+                      " the budget of {1} bytes.".format(total, limit))
+
+    return evicted
+
+
+def _get_usage(data_path, product_inventory):
+    """Returns the last use and size of the products, measuring the sizes
+    not recorded yet."""
+
+    with closing(_connect()) as connection:
+        rows = connection.execute('SELECT uuid, accessed, size FROM usage')
+        usage = {uuid: (accessed, size) for uuid, accessed, size in rows}
+
+        measured = {}
+        for uuid, product in product_inventory.items():
+            accessed, size = usage.get(uuid, (0, None))
+            if size is None:
+                size = _product_size(data_path.joinpath(product['filename']))
+                measured[uuid] = (accessed, size)
+            usage[uuid] = (accessed, size)
+
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO usage VALUES'
+                                   ' (?, ?, ?)',
+                                   [(uuid, accessed, size) for uuid,
+                                    (accessed, size) in measured.items()])
+
+    return usage
+
+
+def _product_size(product_path):
+    """Returns the size on disk of a product file or directory in bytes."""
+
+    if not product_path.is_dir():
+        try:
+            return product_path.stat().st_size
+        except OSError:
+            return 0
+
+    size = 0
+    for root, _, files in os.walk(str(product_path)):
+        for name in files:
+            try:
+                size = size + os.lstat(os.path.join(root, name)).st_size
+            except OSError:  # removed while walking
+                continue
+
+    return size
+
+
+@contextmanager
+def inventory_lock():
+    """Holds the exclusive write lock of the product inventory.
+
+    The lock is shared by all processes and threads using the same DATA_PATH
+    and can be re-entered by its holder, so that a read-modify-write cycle
+    spanning several inventory calls is not interleaved with other writers.
+
+    Example
+    -------
+    ::
+
+        with gs_localmanager.inventory_lock():
+            product = gs_localmanager.get_product(uuid)
+            ...
+            gs_localmanager.add_new_products({uuid: product})
+
+    """
+
+    with _thread_lock:
+        if _lock_state['depth'] == 0:
+            config = UserConfig()
+            data_path = Path(config.DATA_PATH)
+            data_path.mkdir(exist_ok=True)
+            handle = data_path.joinpath(LOCK_FILE).open(mode='a')
+            try:
+                _lock_file(handle)
+            except BaseException:
+                handle.close()
+                raise
+            _lock_state['handle'] = handle
+        _lock_state['depth'] += 1
+        try:
+            yield
+        finally:
+            _lock_state['depth'] -= 1
+            if _lock_state['depth'] == 0:
+                handle = _lock_state.pop('handle')
+                _unlock_file(handle)
+                handle.close()
+
+
+def _lock_file(handle):
+    """Blocks until an exclusive lock on the open file is acquired."""
+
+    if fcntl is not None:
+        # also honoured across NFS clients, where it maps onto fcntl locks
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        return
+
+    handle.seek(0)
+    while True:
+        try:
+            msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:  # gives up after 10 seconds, keep waiting
+            continue
+
+
+def _unlock_file(handle):
+    """Releases the lock taken by `_lock_file`."""
+
+    if fcntl is not None:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+        return
+
+    handle.seek(0)
+    msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _write_json(path, data, **kwargs):
+    """Writes data to a .json file atomically.
+
+    The data is written to a temporary file next to the target, which then
+    replaces it in one step. Readers see either the old or the new contents
+    and a crash never leaves a partially written file behind.
+    """
+
+    temp_path = path.with_name('{0}.{1}.tmp'.format(path.name, os.getpid()))
+    try:
+        with temp_path.open(mode='w') as write_out:
+            json.dump(data, write_out, **kwargs)
+            write_out.flush()
+            os.fsync(write_out.fileno())
+        os.replace(str(temp_path), str(path))
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+
+def audit_products(max_workers=8, full=False):
+    """Audits the files of every inventoried product for corruption.
+
+    The first audit of a product records a manifest of the size, modification
+    time and MD5 hash of each of its files. Later audits only re-hash files
+    whose size or modification time has changed and report those whose hash
+    no longer matches the manifest, as well as any missing files. Files are
+    hashed in parallel.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Number of threads used to read and hash files. Default is 8.
+    full : bool, optional
+        If True, every file is re-hashed regardless of its size and
+        modification time. Default is False.
+
+    Returns
+    -------
+    dict
+        Contains the products that failed the audit keyed by their UUIDs. Each
+        value is a dict with the lists of relative file paths that are
+        'missing' and 'modified'.
+
+    """
+
+    config = UserConfig()
+    data_path = Path(config.DATA_PATH)
+    product_inventory = _get_inventory()
+    manifests = _get_manifests()
+
+    # drop manifests of products that have left the inventory
+    for uuid in list(manifests.keys()):
+        if uuid not in product_inventory:
+            manifests.pop(uuid)
+
+    report = {}
+    to_hash = []  # (uuid, relative path, size, mtime, absolute path)
+
+    for uuid, product in product_inventory.items():
+        product_path = data_path.joinpath(product['filename'])
+        manifest = manifests.setdefault(uuid, {})
+        missing = []
+        if not product_path.exists():
+            missing = list(manifest.keys()) or [product['filename']]
+        else:
+            if product_path.is_dir():
+                files = [x for x in product_path.rglob('*') if x.is_file()]
             else:
-                # product is a processed file
-                new_products[uuid]['origin'] = uuid
-            new_uuid = _get_new_uuid(uuid)
-        product_inventory[new_uuid] = new_products[uuid]
-        added_uuids.append(new_uuid)
+                files = [product_path]
+            present = set()
+            for file_path in files:
+                relative = str(file_path.relative_to(data_path))
+                present.add(relative)
+                stat = file_path.stat()
+                entry = manifest.get(relative)
+                if (full or entry is None or entry['size'] != stat.st_size
+                        or entry['mtime'] != stat.st_mtime_ns):
+                    to_hash.append((uuid, relative, stat.st_size,
+                                    stat.st_mtime_ns, file_path))
+            missing = [x for x in manifest if x not in present]
+        if missing:
+            report[uuid] = {'missing': missing, 'modified': []}
 
-    _save_product_inventory(product_inventory)
+    print("Auditing {0} products, hashing {1} files.".format(
+        len(product_inventory), len(to_hash)))
 
-    return added_uuids
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        hashes = pool.map(lambda job: _hash_file(job[4]), to_hash)
+        for (uuid, relative, size, mtime, _), md5 in zip(to_hash, hashes):
+            manifest = manifests[uuid]
+            entry = manifest.get(relative)
+            if entry is not None and entry['md5'] != md5:
+                # keep the recorded entry so the file is reported until it
+                # is restored
+                report.setdefault(uuid, {'missing': [], 'modified': []})
+                report[uuid]['modified'].append(relative)
+                continue
+            manifest[relative] = {'size': size, 'mtime': mtime, 'md5': md5}
+
+    with inventory_lock():
+        _save_manifests(manifests)
+
+    for uuid, problems in report.items():
+        warnings.warn("Product {0} failed the audit with {1} missing and {2}"
+                      " modified files.".format(
+                          product_inventory[uuid]['filename'],
+                          len(problems['missing']),
+                          len(problems['modified'])))
+
+    return report
+
+
+def _hash_file(file_path):
+    """Returns the MD5 hash of a file."""
+
+    md5hash = hashlib.md5()
+    with open(str(file_path), 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5hash.update(chunk)
+
+    return md5hash.hexdigest()
+
+
+def _get_manifests():
+    """Retrieves the product file manifests from .json file."""
+
+    config = UserConfig()
+    manifests_path = Path(config.DATA_PATH).joinpath(MANIFESTS_FILE)
+    try:
+        with manifests_path.open() as read_in:
+            manifests = json.load(read_in)
+    except (OSError, ValueError):  # no audit has been run yet
+        manifests = {}
+
+    return manifests
+
+
+def _save_manifests(manifests):
+    """Writes the product file manifests to the associated .json file."""
+
+    config = UserConfig()
+    manifests_path = Path(config.DATA_PATH).joinpath(MANIFESTS_FILE)
+    _write_json(manifests_path, manifests)
@@ -4,6 +4,39 @@ This modules takes an individual downloaded product UUID and processing the
 corresponding product. The resultant processed product is stored in the product
 inventory and the new UUID under which it is stored is returned.
 
+Processed products record the processor used and a hash of its
+configuration, i.e. the contents of the gpt graph, or the sen2cor version and
+the contents of the L2A_GIPP.xml configuration it uses. A product that has
+already been processed with the same configuration is not processed again,
+the existing processed product is returned instead.
+
+Each run works in its own hidden directory in the DATA_PATH, from which the
+finished product is moved into the DATA_PATH and added to the inventory. The
+output of the tool is written to a log in the .processing_logs directory of
+the DATA_PATH, so several products can be processed at once with
+`batch_process`.
+
+Processing jobs are packed onto the host by a `ProcessingScheduler`, which
+estimates the memory and CPUs each job needs from the product type and
+resolution and only starts jobs that fit within the host limits. The limits
+default to 80% of the physical memory and all CPUs and can be set with
+`processing_memory` (in GB) and `processing_cpus` in the gs_config.json. gpt
+is run with its heap, tile cache (-c) and parallelism (-q) sized to the share
+allocated to the job.
+
+Sentinel-1 products can be processed for a set of regions of interest only,
+e.g. the `ROIs` of a `gs_stacker.Stacker`. A Subset of the extent of the ROIs
+covered by the product, plus a margin, is then inserted after the Read node of
+the gpt graph, so that the processing time and output size scale with the
+area of interest rather than the scene. Subset outputs are named and
+inventoried by the hash of their region, with the region as their footprint.
+
+sen2cor can be limited to the resolution needed, e.g. the resolution of the
+bands set on a `Stacker`, as producing the 10 m bands is the most expensive
+part of its run. Level-2A products record the `resolutions` they contain. A
+product processed at a coarser resolution than requested is processed again
+at the requested one, otherwise it is reused.
+
 Note
 ----
 Sentinel-2 products that are not Level-1C will be skipped and their current
@@ -13,28 +46,222 @@ Example
 -------
 ::
 
-    from getsentinel import gs_process
+    from getsentinel import gs_processor, gs_stacker
 
     level1c_s2products = {uuid: info, uuid: info}
 
-    for uuid in level1c_s2products:
-        level2a_s2products = gs_process.batch_process(uuid)
+    level2a_s2products = gs_processor.batch_process(level1c_s2products)
 
-"""
-# TODO: Implement processed project inventory checking to prevent re-processing
-# products that have already been processed.
+    # process at most two products at a time, within 16 GB of memory
+    scheduler = gs_processor.ProcessingScheduler(memory=16)
+    level2a_s2products = gs_processor.batch_process(level1c_s2products,
+                                                    max_workers=2,
+                                                    scheduler=scheduler)
 
+    # process Sentinel-1 products only where they cover the stacker ROIs
+    stacker = gs_stacker.Stacker(level1_s1products, geo_files, start, end)
+    processed_s1products = gs_processor.batch_process(
+        level1_s1products, gpt_graph='graph.xml', rois=stacker.ROIs)
+
+    # only produce the resolution of the Sentinel-2 bands to be stacked
+    stacker.set_bands(s2_band_list=['B05', 'B8A'])
+    level2a_s2products = gs_processor.batch_process(
+        level1c_s2products, resolution=stacker.s2_processing_resolution())
+
+"""
 
 from pathlib import Path
+import concurrent.futures
+import contextlib
+import datetime
+import hashlib
+import os
+import re
 import shutil
 import subprocess
-from . import gs_localmanager, gs_config
+import tempfile
+import threading
+import time
+import warnings
+import xml.etree.ElementTree as ET
+from shapely import wkt
+from shapely.ops import unary_union
+from . import gs_localmanager
+from .gs_product import as_product
+from .gs_config import UserConfig
+
+
+# directory of the processing tool logs in the DATA_PATH
+LOGS_DIR = '.processing_logs'
+# estimated peak memory in GB and CPUs of a job, by processor and product
+# type for gpt and by the finest resolution produced for sen2cor
+JOB_RESOURCES = {('gpt', 'GRD'): (8, 4),
+                 ('sen2cor', 10): (8, 2),
+                 ('sen2cor', 20): (4, 1),
+                 ('sen2cor', 60): (2, 1)}
+DEFAULT_JOB_RESOURCES = (8, 2)
+# share of the gpt heap given to its tile cache
+GPT_CACHE_SHARE = 0.7
+# margin added around the ROIs of a subset, in degrees (about 1 km)
+SUBSET_MARGIN = 0.01
+# smallest share of the scene memory estimate given to a subset
+MIN_SUBSET_SHARE = 0.25
+# resolutions in m produced by sen2cor run with each --resolution, all of
+# them without
+SEN2COR_RESOLUTIONS = {10: [10, 20, 60], 20: [20, 60], 60: [60]}
+# id of the Subset node inserted into gpt graphs
+SUBSET_NODE = 'Subset-ROI'
+# version in the help text of sen2cor, e.g. 'Version: 2.8.0, created: ...'
+SEN2COR_VERSION = re.compile(r'Version:\s*([0-9][0-9.]*[0-9])')
+# sen2cor versions by tool path and modification time, see _sen2cor_version
+_tool_versions = {}
+# tool processes currently running, killed if a batch is interrupted
+_running = set()
+_running_lock = threading.Lock()
+# set when a batch is interrupted, so that no further tools are started
+_cancelled = threading.Event()
+# seconds between checks for a cancellation while waiting for resources
+CANCEL_POLL = 0.5
+# scheduler shared by all processing in this process, see _get_scheduler
+_scheduler = []
+
+
+class ProcessingScheduler():
+    """Packs processing jobs within the memory and CPU limits of the host.
+
+    A job is only started once its estimated memory and CPU needs fit within
+    what the running jobs have left. A job needing more than the limits is
+    given all of them and runs alone.
 
+    Parameters
+    ----------
+    memory : float, optional
+        Memory in GB available for processing. Defaults to
+        `processing_memory` in the gs_config.json, or else 80% of the
+        physical memory.
+    cpus : int, optional
+        CPUs available for processing. Defaults to `processing_cpus` in the
+        gs_config.json, or else all CPUs.
+
+    Attributes
+    ----------
+    memory : float
+        The memory limit in GB.
+    cpus : int
+        The CPU limit.
+
+    """
 
-def batch_process(product_inventory, gpt_graph=False):
+    def __init__(self, memory=None, cpus=None):
+        config = UserConfig()
+        if memory is None:
+            memory = config.PROCESSING_MEMORY
+        if memory is None:
+            memory = 0.8 * (_host_memory() or 10)
+        if cpus is None:
+            cpus = config.PROCESSING_CPUS
+        if cpus is None:
+            cpus = os.cpu_count() or 1
+        if memory <= 0 or cpus < 1:
+            raise ValueError("The processing limits must be positive.")
+
+        self.memory = memory
+        self.cpus = cpus
+        self._free_memory = memory
+        self._free_cpus = cpus
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def allocate(self, memory, cpus):
+        """Blocks until the resources are free and holds them.
+
+        Parameters
+        ----------
+        memory : float
+            Memory needed in GB.
+        cpus : int
+            CPUs needed.
+
+        Yields
+        ------
+        tuple
+            The memory in GB and the CPUs allocated.
+
+        Raises
+        ------
+        ProcessingError
+            If the processing is cancelled while waiting.
+
+        """
+
+        memory = min(memory, self.memory)
+        cpus = min(cpus, self.cpus)
+
+        with self._condition:
+            while True:
+                if _cancelled.is_set():
+                    raise ProcessingError("Processing was cancelled.")
+                if memory <= self._free_memory and cpus <= self._free_cpus:
+                    break
+                self._condition.wait(CANCEL_POLL)
+            self._free_memory = self._free_memory - memory
+            self._free_cpus = self._free_cpus - cpus
+        try:
+            yield memory, cpus
+        finally:
+            with self._condition:
+                self._free_memory = self._free_memory + memory
+                self._free_cpus = self._free_cpus + cpus
+                self._condition.notify_all()
+
+
+def estimate_resources(product, processor, resolution=None, region=None):
+    """Returns the estimated peak memory in GB and CPUs of processing a
+    product, see `JOB_RESOURCES`.
+
+    Parameters
+    ----------
+    product : dict
+        The product info.
+    processor : str
+        The processor, 'sen2cor' or 'gpt'.
+    resolution : int, optional
+        The finest resolution produced by sen2cor in m. Default is 10, i.e.
+        all resolutions.
+    region : str, optional
+        WKT of the region a gpt run is subset to. The memory is scaled by the
+        share of the footprint it covers, down to `MIN_SUBSET_SHARE`.
+
+    Returns
+    -------
+    tuple
+        The memory in GB and the number of CPUs.
+
+    """
+
+    if processor == 'sen2cor':
+        key = (processor, resolution or 10)
+    else:
+        key = (processor, product.get('producttype'))
+
+    memory, cpus = JOB_RESOURCES.get(key, DEFAULT_JOB_RESOURCES)
+
+    footprint = as_product(product).shape
+    if region and footprint is not None and footprint.area:
+        share = wkt.loads(region).intersection(footprint).area / footprint.area
+        memory *= max(MIN_SUBSET_SHARE, share)
+
+    return memory, cpus
+
+
+def batch_process(product_inventory, gpt_graph=False, reprocess=False,
+                  max_workers=None, scheduler=None, rois=None,
+                  resolution=None):
     """Processes a batch of product and returns the new processed products
     uuids and info.
 
+    Products whose processing fails are skipped with a warning.
+
     Parameters
     ----------
     product_inventory : dict
@@ -42,26 +269,83 @@ def batch_process(product_inventory, gpt_graph=False):
     gpt_graph : str, optional
         The path to the gpt tool graph to be used to process any Sentinel-1
         products supplied.
+    reprocess : bool, optional
+        If True, products are processed even if they have already been
+        processed with the same configuration.
+    max_workers : int, optional
+        Maximum number of products processed at the same time. By default as
+        many as the scheduler fits on the host.
+    scheduler : :obj:`ProcessingScheduler`, optional
+        Packs the jobs within the host limits. By default a scheduler with
+        the configured limits, shared by all processing in this process.
+    rois : dict or list, optional
+        Shapely geometries in WGS84, e.g. the `ROIs` of a `Stacker`, to
+        which the Sentinel-1 products are subset. Products covering none of
+        them are skipped with a warning.
+    resolution : int, optional
+        The resolution in m, 10, 20 or 60, needed of the Sentinel-2
+        products, e.g. `Stacker.s2_processing_resolution()`. By default all
+        resolutions are produced.
 
     Returns
     -------
     dict
-        Contains the new processed product uuids and info.
+        Contains the new processed product uuids and info, in the order of
+        the products supplied.
 
     """
 
+    uuids = list(product_inventory)
+    if scheduler is None:
+        scheduler = _get_scheduler()
+    if max_workers is None:
+        # every job needs at least one CPU
+        max_workers = max(1, min(len(uuids), scheduler.cpus))
+    _cancelled.clear()
+    # the work is done by the tool processes, threads only wait on them
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+    jobs = []
+    try:
+        for uuid in uuids:
+            jobs.append(pool.submit(process, uuid, gpt_graph, reprocess,
+                                    scheduler, rois, resolution))
+        concurrent.futures.wait(jobs)
+    except KeyboardInterrupt:
+        # stop the jobs waiting for resources or about to start a tool
+        _cancelled.set()
+        for job in jobs:
+            job.cancel()
+        with _running_lock:
+            for running in _running:
+                running.kill()
+        raise
+    finally:
+        pool.shutdown(cancel_futures=True)
+
     processed_products = {}
 
-    for uuid in product_inventory:
-        new_uuid, new_info = process(uuid, gpt_graph)
+    for uuid, job in zip(uuids, jobs):
+        try:
+            new_uuid, new_info = job.result()
+        except ProcessingError as error:
+            warnings.warn("Product {0} was not processed: {1}".format(
+                uuid, error))
+            continue
         processed_products[new_uuid] = new_info
 
     return processed_products
 
 
-def process(uuid, gpt_graph=False):
+def process(uuid, gpt_graph=False, reprocess=False, scheduler=None,
+            rois=None, resolution=None):
     """Channels a product through the corresponding ESA processing tool.
 
+    If the product has already been processed with the same processor and
+    configuration the existing processed product is returned straight away.
+    For a subset this includes a product processed for the same region or
+    for the whole scene, for sen2cor only a product that contains the
+    resolution needed.
+
     Parameters
     ----------
     uuid : str
@@ -69,6 +353,21 @@ def process(uuid, gpt_graph=False):
     gpt_graph : str, optional
         The path to the gpt tool graph to be used to process a Sentinel-1
         product.
+    reprocess : bool, optional
+        If True, the product is processed even if it has already been
+        processed with the same configuration.
+    scheduler : :obj:`ProcessingScheduler`, optional
+        Holds back the processing until it fits within the host limits. By
+        default a scheduler with the configured limits, shared by all
+        processing in this process.
+    rois : dict or list, optional
+        Shapely geometries in WGS84, e.g. the `ROIs` of a `Stacker`. A
+        Sentinel-1 product is only processed for the extent of those it
+        covers, plus `SUBSET_MARGIN`. Ignored for Sentinel-2 products.
+    resolution : int, optional
+        The resolution in m, 10, 20 or 60, needed of a Sentinel-2 product.
+        sen2cor then only produces it and the coarser resolutions, see
+        `SEN2COR_RESOLUTIONS`. By default all resolutions are produced.
 
     Returns
     -------
@@ -79,113 +378,515 @@ def process(uuid, gpt_graph=False):
         Contains the new product info with parameters changed to reflect the
         processing that has occured.
 
+    Raises
+    ------
+    ProcessingError
+        If the processing tool fails or the product covers none of the rois.
+
     """
 
-    inventory = gs_localmanager.get_product_inventory()
+    if resolution is not None and resolution not in SEN2COR_RESOLUTIONS:
+        raise ValueError("The resolution must be 10, 20 or 60, not "
+                         "{0}.".format(resolution))
 
-    product = inventory[uuid]
+    product = gs_localmanager.get_product(uuid)
     platform = product['platformname']
+    config = UserConfig()
 
     if platform == 'Sentinel-1':
         if not gpt_graph:
             raise RuntimeError("You must supply a SNAP generated Sentinel-1 "
                                "processing .xml graph file when processing "
                                " Sentinel-1 products.")
-        new_uuid, new_product = _s1process(uuid, product, gpt_graph)
+        processor = 'gpt'
+        processhash = config_hash(processor, gpt_graph,
+                                  tool=config.GPT_ROOT_PATH)
+        # products processed for the whole scene also cover any subset
+        processhashes = [processhash]
+        region = None
+        if rois is not None:
+            region = _subset_region(product, rois)
+            processhash = config_hash(processor, gpt_graph,
+                                      tool=config.GPT_ROOT_PATH,
+                                      region=region)
+            processhashes.insert(0, processhash)
 
     if platform == 'Sentinel-2':
-        new_uuid, new_product = _s2process(uuid, product)
+        # Skip downloaded products that are Level-2A already
+        if '2A' in product['processinglevel']:
+            gs_localmanager.touch_products([uuid])
+            return uuid, product
+        processor = 'sen2cor'
+        version = _sen2cor_version(config.SEN2COR_ROOT_PATH)
+        processhash = config_hash(processor,
+                                  _sen2cor_config(config.SEN2COR_ROOT_PATH,
+                                                  version),
+                                  tool=config.SEN2COR_ROOT_PATH,
+                                  version=version)
+        processhashes = [processhash]
 
     if platform == 'Sentinel-3':
         raise NotImplementedError
 
+    for known_hash in ([] if reprocess else processhashes):
+        # the inventory was checked by get_product above
+        processed = gs_localmanager.find_derived(uuid, processor, known_hash,
+                                                 trust_cache=True)
+        if processor == 'sen2cor' and processed:
+            # all resolutions are needed unless one is given
+            covering = _with_resolution(processed, resolution or 10)
+            if not covering:
+                print("Product {0} has only been processed with sen2cor at "
+                      "resolutions coarser than {1} m - processing "
+                      "again.".format(product['filename'], resolution or 10))
+            processed = covering
+        if processed:
+            # find_derived returns the most recently processed last
+            new_uuid = list(processed)[-1]
+            print("Product {0} has already been processed with {1} as {2}"
+                  " - skipping.".format(product['filename'], processor,
+                                        processed[new_uuid]['filename']))
+            gs_localmanager.touch_products([uuid, new_uuid])
+            return new_uuid, processed[new_uuid]
+
+    if scheduler is None:
+        scheduler = _get_scheduler()
+
+    if processor == 'gpt':
+        new_uuid, new_product = _s1process(uuid, product, gpt_graph,
+                                           processhash, scheduler, region)
+
+    if processor == 'sen2cor':
+        new_uuid, new_product = _s2process(uuid, product, processhash,
+                                           scheduler, resolution)
+
+    gs_localmanager.touch_products([uuid, new_uuid])
+
     return new_uuid, new_product
 
 
-def _s1process(uuid, product, gpt_graph):
-    """Processed the product using gpt tool."""
+def config_hash(processor, config_file=False, **options):
+    """Returns the hash identifying a processor configuration.
+
+    Parameters
+    ----------
+    processor : str
+        The processor, 'sen2cor' or 'gpt'.
+    config_file : str, optional
+        Path to a configuration file, e.g. a gpt graph, whose contents are
+        part of the configuration.
+    **options
+        Any further settings, e.g. the path to the processing tool.
+
+    Returns
+    -------
+    str
+        The MD5 hex digest of the configuration.
+
+    """
+
+    md5hash = hashlib.md5(processor.encode())
+    if config_file:
+        md5hash.update(Path(config_file).read_bytes())
+    md5hash.update(repr(sorted(options.items())).encode())
+
+    return md5hash.hexdigest()
+
+
+def _sen2cor_version(sen2cor):
+    """Returns the version of the sen2cor tool from its help text, None if it
+    cannot be found.
+
+    The version is looked up once per tool path and modification time.
+    """
+
+    try:
+        key = (sen2cor, os.stat(sen2cor).st_mtime_ns)
+    except OSError:
+        return None
+
+    if key not in _tool_versions:
+        try:
+            output = subprocess.run([sen2cor, '--help'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    timeout=60).stdout.decode(errors='replace')
+        except (OSError, subprocess.SubprocessError):
+            output = ''
+        match = SEN2COR_VERSION.search(output)
+        _tool_versions[key] = match.group(1) if match else None
+
+    return _tool_versions[key]
+
+
+def _sen2cor_config(sen2cor, version=None):
+    """Returns the path to the L2A_GIPP.xml configuration file sen2cor uses,
+    False if it cannot be found.
+
+    sen2cor reads the file in the cfg directory of its SEN2COR_HOME, by
+    default ~/sen2cor/<major.minor version>, which is created from the
+    template in the installation on its first run.
+    """
+
+    candidates = []
+    if os.environ.get('SEN2COR_HOME'):
+        candidates.append(Path(os.environ['SEN2COR_HOME'], 'cfg'))
+    elif version:
+        candidates.append(Path.home().joinpath(
+            'sen2cor', '.'.join(version.split('.')[:2]), 'cfg'))
+    # the template of the installation, <install>/bin/L2A_Process
+    installation = Path(sen2cor).resolve().parent.parent
+    candidates.extend(sorted(installation.glob(
+        'lib/python*/site-packages/sen2cor/cfg')))
+
+    for candidate in candidates:
+        gipp = candidate.joinpath('L2A_GIPP.xml')
+        if gipp.is_file():
+            return gipp
+
+    return False
+
+
+def _s1process(uuid, product, gpt_graph, processhash, scheduler,
+               region=None):
+    """Processed the product using gpt tool, subset to the region WKT if
+    given."""
 
     if product['producttype'] != 'GRD':
         raise NotImplementedError("Only GRD Sentinel-1 files currently "
                                   "supported.")
 
-    infile = Path(gs_config.DATA_PATH).joinpath(product['filename'])
-    intarget = '-Pinput1="{0}"'.format(infile)
+    config = UserConfig()
+    infile = Path(config.DATA_PATH).resolve().joinpath(product['filename'])
 
-    graph_name = gpt_graph.split('.')[0]
+    graph_name = Path(gpt_graph).stem
+    if region:
+        graph_name += '_ROI{0}'.format(_region_hash(region))
     outname = infile.stem + '_PROC_{0}.tif'.format(graph_name)
-    outfile = infile.with_name(outname)
-    outtarget = '-Ptarget1="{0}"'.format(outfile)
 
-    gpt = gs_config.GPT_ROOT_PATH
+    workdir = _make_workdir()
+    try:
+        graph_path = Path(gpt_graph).resolve()
+        if region:
+            graph_path = _subset_graph(graph_path, region, workdir)
+        command = [config.GPT_ROOT_PATH, str(graph_path),
+                   '-Pinput1={0}'.format(infile),
+                   '-Ptarget1={0}'.format(workdir.joinpath(outname))]
+        # keep gpt from picking up other GDAL libraries
+        environment = dict(os.environ, LD_LIBRARY_PATH='.')
+        _run_tool(command, workdir, product, 'gpt', processhash, scheduler,
+                  estimate_resources(product, 'gpt', region=region),
+                  environment)
+
+        with gs_localmanager.inventory_lock():
+            _move_output(workdir.joinpath(outname))
+            new_uuid, new_product = _add_processed(uuid, product, outname,
+                                                   'gpt', processhash,
+                                                   gpt_graph=gpt_graph,
+                                                   region=region)
+    finally:
+        shutil.rmtree(str(workdir), ignore_errors=True)
 
-    gdal_conf = 'LD_LIBRARY_PATH=.'
+    return new_uuid, new_product
 
-    command = '{0} {1} {2} {3} {4}'.format(gdal_conf, gpt, gpt_graph, intarget,
-                                           outtarget)
 
-    print(command)
+def _s2process(uuid, product, processhash, scheduler, resolution=None):
+    """Process a Level 1C Sentinel-2 file using S2, at the resolution and
+    the coarser ones if given."""
 
-    try:
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-        for line in process.stdout:
-            print(line.decode().strip())
-    except KeyboardInterrupt:
-        outfile.unlink()
-        raise KeyboardInterrupt
+    config = UserConfig()
+    filepath = Path(config.DATA_PATH).resolve().joinpath(product['filename'])
 
-    new_uuid, new_product = _add_processed(uuid, product, outfile,
-                                           gpt_graph=gpt_graph)
+    workdir = _make_workdir()
+    try:
+        command = [config.SEN2COR_ROOT_PATH, str(filepath),
+                   '--output_dir', str(workdir)]
+        if resolution:
+            command += ['--resolution', str(resolution)]
+        _run_tool(command, workdir, product, 'sen2cor', processhash,
+                  scheduler, estimate_resources(product, 'sen2cor',
+                                                resolution))
+
+        outputs = [x for x in workdir.iterdir() if x.name.endswith('.SAFE')]
+        if len(outputs) != 1:
+            raise ProcessingError("sen2cor did not produce a single Level-2A"
+                                  " product for {0}.".format(
+                                      product['filename']))
+        outname = outputs[0].name
+        resolutions = (_safe_resolutions(outputs[0]) or
+                       SEN2COR_RESOLUTIONS[resolution or 10])
+
+        with gs_localmanager.inventory_lock():
+            _move_output(outputs[0])
+            new_uuid, new_product = _add_processed(uuid, product, outname,
+                                                   'sen2cor', processhash,
+                                                   'Level-2A', 'S2MSI2A',
+                                                   resolutions=resolutions)
+    finally:
+        shutil.rmtree(str(workdir), ignore_errors=True)
 
     return new_uuid, new_product
 
 
-def _s2process(uuid, product):
-    """Process a Level 1C Sentinel-2 file using S2."""
+def _with_resolution(processed, resolution):
+    """Returns the sen2cor processed products that contain the resolution.
+    """
+
+    covering = {}
+    for new_uuid, new_product in processed.items():
+        # products processed before resolutions were recorded have all
+        resolutions = new_product.get('resolutions', SEN2COR_RESOLUTIONS[10])
+        if resolution in resolutions:
+            covering[new_uuid] = new_product
+
+    return covering
+
+
+def _safe_resolutions(safe_path):
+    """Returns the resolutions of the IMG_DATA/R<resolution>m directories
+    of a Level-2A .SAFE directory, an empty list if there are none."""
+
+    resolutions = set()
+    for img_data in safe_path.glob('GRANULE/*/IMG_DATA/R*m'):
+        try:
+            resolutions.add(int(img_data.name[1:-1]))
+        except ValueError:
+            continue
+
+    return sorted(resolutions)
+
+
+def _subset_region(product, rois):
+    """Returns the WKT of the extent, plus `SUBSET_MARGIN`, of the rois
+    covered by the product.
+
+    Raises
+    ------
+    ProcessingError
+        If the product covers none of the rois.
+
+    """
+
+    if isinstance(rois, dict):
+        rois = list(rois.values())
+    elif not isinstance(rois, (list, tuple, set)):
+        rois = [rois]
+
+    footprint = as_product(product).shape
+    if footprint is not None:
+        rois = [roi for roi in rois if roi.intersects(footprint)]
+    if not rois:
+        raise ProcessingError("Product {0} covers none of the ROIs.".format(
+            product['filename']))
+
+    # gpt subsets the bounding pixel rectangle of the region in any case
+    region = unary_union(rois).buffer(SUBSET_MARGIN).envelope
+
+    # rounded so that the same rois give the same hash
+    return wkt.dumps(region, rounding_precision=6)
 
-    # Skip downloaded products that are Level-2A already
-    if '2A' in product['processinglevel']:
-        return uuid, product
 
-    filename = product['filename']
-    filepath = Path(gs_config.DATA_PATH).joinpath(filename)
-    # NOTE: This is per the sen2cor renaming convention. May break.
-    outname = filename[:8] + '2A' + filename[10:]
-    outpath = Path(gs_config.DATA_PATH).joinpath(outname)
+def _region_hash(region):
+    """Returns the short hash naming the outputs subset to a region."""
+
+    return hashlib.md5(region.encode()).hexdigest()[:8]
+
+
+def _subset_graph(gpt_graph, region, workdir):
+    """Writes a copy of the gpt graph with a Subset of the region inserted
+    after its Read node to workdir and returns its path.
+
+    Raises
+    ------
+    ProcessingError
+        If the graph does not have a single Read node.
+
+    """
+
+    tree = ET.parse(str(gpt_graph))
+    graph = tree.getroot()
+    nodes = graph.findall('node')
+    reads = [node for node in nodes
+             if (node.findtext('operator') or '').strip() == 'Read']
+    if len(reads) != 1:
+        raise ProcessingError("The gpt graph {0} must have a single Read node"
+                              " to be subset.".format(gpt_graph))
+    read_id = reads[0].get('id')
+
+    # read the sources of the other nodes from the subset instead
+    for node in nodes:
+        for source in node.findall('sources/*'):
+            if source.get('refid') == read_id:
+                source.set('refid', SUBSET_NODE)
+            elif (source.text or '').strip() == read_id:
+                source.text = SUBSET_NODE
+
+    subset = ET.Element('node', id=SUBSET_NODE)
+    ET.SubElement(subset, 'operator').text = 'Subset'
+    sources = ET.SubElement(subset, 'sources')
+    ET.SubElement(sources, 'sourceProduct', refid=read_id)
+    parameters = ET.SubElement(subset, 'parameters')
+    parameters.set('class', 'com.bc.ceres.binding.dom.XppDomElement')
+    ET.SubElement(parameters, 'geoRegion').text = region
+    ET.SubElement(parameters, 'copyMetadata').text = 'true'
+    graph.insert(list(graph).index(reads[0]) + 1, subset)
+
+    graph_path = workdir.joinpath(Path(gpt_graph).name)
+    tree.write(str(graph_path))
+
+    return graph_path
+
+
+def _make_workdir():
+    """Creates a hidden working directory for a processing run in the
+    DATA_PATH, on the same file system as the finished products."""
+
+    config = UserConfig()
+
+    return Path(tempfile.mkdtemp(prefix='.processing-',
+                                 dir=config.DATA_PATH)).resolve()
+
+
+def _run_tool(command, workdir, product, processor, processhash, scheduler,
+              resources, environment=None):
+    """Runs a processing tool in workdir with its output written to a log,
+    once the scheduler has allocated the estimated resources to it.
+
+    Raises
+    ------
+    ProcessingError
+        If the tool exits with an error.
+
+    """
+
+    config = UserConfig()
+    logs_path = Path(config.DATA_PATH).joinpath(LOGS_DIR)
+    logs_path.mkdir(exist_ok=True)
+    log_path = logs_path.joinpath('{0}.{1}.{2}.log'.format(
+        product['identifier'], processor, processhash[:8]))
+
+    with scheduler.allocate(*resources) as (memory, cpus):
+        if processor == 'gpt':
+            # size the heap, tile cache and parallelism to the allocation
+            heap = int(memory * 1024)
+            command = command + ['-q', str(cpus), '-c', '{0}M'.format(
+                int(heap * GPT_CACHE_SHARE))]
+            environment = dict(environment or os.environ,
+                               _JAVA_OPTIONS='-Xmx{0}m'.format(heap))
+        returncode = _run_logged(command, workdir, environment, log_path,
+                                 product, processor)
+
+    if returncode != 0:
+        raise ProcessingError("{0} exited with code {1}, see {2}".format(
+            processor, returncode, log_path))
+
+
+def _run_logged(command, workdir, environment, log_path, product, processor):
+    """Runs a command with its output written to log_path and returns its
+    exit code."""
+
+    print("Processing product {0} with {1}, logging to {2}.".format(
+        product['filename'], processor, log_path))
+    started = time.monotonic()
+
+    with log_path.open(mode='w') as log:
+        log.write(' '.join(command) + '\n')
+        log.flush()
+        # started and registered at once, so a cancellation either sees and
+        # kills the tool or is seen here
+        with _running_lock:
+            if _cancelled.is_set():
+                raise ProcessingError("Processing was cancelled.")
+            process = subprocess.Popen(command, cwd=str(workdir), stdout=log,
+                                       stderr=subprocess.STDOUT,
+                                       env=environment)
+            _running.add(process)
+        try:
+            returncode = process.wait()
+        except KeyboardInterrupt:
+            process.kill()
+            raise
+        finally:
+            with _running_lock:
+                _running.discard(process)
+
+    if returncode == 0:
+        print("Processed product {0} with {1} in {2:.0f} s.".format(
+            product['filename'], processor, time.monotonic() - started))
+
+    return returncode
+
+
+def _get_scheduler():
+    """Returns the scheduler shared by all processing in this process."""
+
+    with _running_lock:
+        if not _scheduler:
+            _scheduler.append(ProcessingScheduler())
+
+    return _scheduler[0]
+
+
+def _host_memory():
+    """Returns the physical memory of the host in GB, None if unknown."""
 
     try:
-        process = subprocess.Popen([gs_config.SEN2COR_ROOT_PATH, filepath],
-                                   stdout=subprocess.PIPE)
+        return (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') /
+                1024**3)
+    except (AttributeError, ValueError, OSError):  # e.g. on Windows
+        return None
 
-        for line in process.stdout:
-            print(line.decode().strip())
-    except KeyboardInterrupt:
-        process.kill()
-        shutil.rmtree(outpath)
-        raise KeyboardInterrupt
 
-    new_uuid, new_product = _add_processed(uuid, product, outname, 'Level-2A',
-                                           'S2MSI2A')
+def _move_output(output):
+    """Moves a processing output into the DATA_PATH, replacing any earlier
+    output of the same name."""
 
-    return new_uuid, new_product
+    config = UserConfig()
+    target = Path(config.DATA_PATH).joinpath(output.name)
+    if target.is_dir():
+        shutil.rmtree(str(target))
+    elif target.exists():
+        target.unlink()
+    output.replace(target)
 
 
-def _add_processed(uuid, product, newfilename, proclevel=False, prodtype=False,
-                   gpt_graph=False):
+def _add_processed(uuid, product, newfilename, processor, processhash,
+                   proclevel=False, prodtype=False, gpt_graph=False,
+                   region=None, resolutions=None):
     """Adds a new processed product to the product inventory."""
 
     product['userprocessed'] = True
     product['filename'] = newfilename
     product['identifier'] = newfilename.split('.')[0]
+    product['processor'] = processor
+    product['processhash'] = processhash
+    product['processed'] = datetime.datetime.now(
+        datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
     if proclevel:
         product['processinglevel'] = proclevel
     if prodtype:
         product['producttype'] = prodtype
     if gpt_graph:
         product['gpt_graph'] = gpt_graph
+    if region:
+        # the subset only covers the region within the scene
+        footprint = as_product(product).shape
+        shape = wkt.loads(region)
+        if footprint is not None:
+            shape = shape.intersection(footprint)
+        product['footprint'] = shape.wkt
+        product['roi'] = region
+        product['roihash'] = _region_hash(region)
+    if resolutions:
+        product['resolutions'] = resolutions
     product['origin'] = uuid
 
     # One product added, returns a list containing a single id
     new_uuid = gs_localmanager.add_new_products({uuid: product})[0]
 
     return new_uuid, product
+
+
+class ProcessingError(Exception):
+    """Processing Exception for when a processing tool fails."""
+    pass
@@ -0,0 +1,172 @@
+"""Compact product records.
+
+Product info is passed around getsentinel as dictionaries of about thirty
+string fields, see `gs_localmanager` for the format. `Product` is a `dict`
+holding the same fields, so it can be used wherever product info dicts are
+used, e.g. stored in the inventory or written out as JSON, but it
+
+- shares the field names and the values that are common to many products,
+  such as the platform or product type, between all products, and
+- parses the sensing times and the footprint once, on first use, and keeps
+  the parsed values.
+
+The product lists returned by `gs_downloader` and `gs_localmanager` hold
+`Product` records.
+
+Example
+-------
+::
+
+    from getsentinel import gs_product
+
+    product = gs_product.Product(product_info)
+
+    product['platformname']  # 'Sentinel-1'
+    product.begin  # datetime.datetime(2015, 8, 24, 6, 22, 7)
+    product.shape.area  # the footprint as a shapely geometry
+
+    # parses only products that are not Product records already
+    products = {uuid: gs_product.as_product(info)
+                for uuid, info in product_list.items()}
+
+"""
+
+import datetime
+import sys
+from shapely import wkt
+from shapely.errors import ShapelyError
+
+
+# fields with few distinct values, shared between all products
+SHARED_FIELDS = ['acquisitiontype', 'format', 'instrumentname',
+                 'instrumentshortname', 'orbitdirection', 'platformidentifier',
+                 'platformname', 'polarisationmode', 'processinglevel',
+                 'productclass', 'producttype', 'sensoroperationalmode',
+                 'status', 'swathidentifier', 'processor', 'processhash']
+_SHARED = frozenset(SHARED_FIELDS)
+
+
+class Product(dict):
+    """Product info dictionary with lazily parsed times and footprint.
+
+    Takes the same arguments as `dict`.
+
+    Attributes
+    ----------
+    begin : datetime.datetime
+        The sensing start time, `beginposition`, to the second. None if not
+        known.
+    end : datetime.datetime
+        The sensing stop time, `endposition`, to the second. None if not
+        known.
+    shape : shapely.geometry.base.BaseGeometry
+        The `footprint` in WGS84. None if not known or not valid WKT.
+
+    Note
+    ----
+    The parsed values are cached against the field values they were parsed
+    from and parsed again if those are replaced.
+
+    """
+
+    __slots__ = ('_begin', '_end', '_shape')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._begin = self._end = self._shape = (None, None)
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(*_compact(key, value))
+
+    def update(self, *args, **kwargs):
+        """Updates the product as `dict.update` does."""
+
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        """Returns the value of key, setting it to default if not present."""
+
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def copy(self):
+        """Returns a copy of the product, including the parsed values."""
+
+        product = Product()
+        dict.update(product, self)
+        product._begin = self._begin
+        product._end = self._end
+        product._shape = self._shape
+        return product
+
+    def __reduce__(self):
+        return (Product, (dict(self),))
+
+    @property
+    def begin(self):
+        raw = self.get('beginposition')
+        if self._begin[0] is not raw:
+            self._begin = (raw, _parse_time(raw))
+        return self._begin[1]
+
+    @property
+    def end(self):
+        raw = self.get('endposition')
+        if self._end[0] is not raw:
+            self._end = (raw, _parse_time(raw))
+        return self._end[1]
+
+    @property
+    def shape(self):
+        raw = self.get('footprint')
+        if self._shape[0] is not raw:
+            self._shape = (raw, _parse_footprint(raw))
+        return self._shape[1]
+
+
+def as_product(product):
+    """Returns the product info as a `Product`, itself if it already is one.
+    """
+
+    if isinstance(product, Product):
+        return product
+    return Product(product)
+
+
+def _compact(key, value):
+    """Returns the key, and the value if of a shared field, as the single
+    shared copy of the string."""
+
+    if isinstance(key, str):
+        key = sys.intern(key)
+        if isinstance(value, str) and key in _SHARED:
+            value = sys.intern(value)
+    return key, value
+
+
+def _parse_time(time_string):
+    """Creates a datetime from an ESA time string, e.g.
+    '2015-08-24T06:22:07.95Z', ignoring fractions of a second."""
+
+    if not time_string:
+        return None
+    return datetime.datetime(int(time_string[0:4]),
+                             int(time_string[5:7]),
+                             int(time_string[8:10]),
+                             int(time_string[11:13]),
+                             int(time_string[14:16]),
+                             int(time_string[17:19]))
+
+
+def _parse_footprint(footprint):
+    """Loads a WKT footprint, None if it is missing or invalid."""
+
+    if not footprint:
+        return None
+    try:
+        return wkt.loads(footprint)
+    except (ShapelyError, ValueError):
+        return None
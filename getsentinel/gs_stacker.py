@@ -33,7 +33,6 @@ Example
 # Revisit non-uniform arrays after masking. Is it fixed after applying orbit
 # files in gpt?
 
-import datetime
 import warnings
 from pathlib import Path
 import numpy as np
@@ -43,6 +42,16 @@ import rasterio
 import rasterio.mask
 from osgeo import osr, ogr
 from .gs_config import UserConfig
+from .gs_product import as_product
+from . import gs_localmanager
+
+
+# Sentinel-2 Level-2A bands by resolution in m
+S2_BANDS = {10: ['AOT', 'B02', 'B03', 'B04', 'B08', 'TCI', 'WVP'],
+            20: ['AOT', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B11',
+                 'B12', 'SCL', 'TCI', 'WVP'],
+            60: ['AOT', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B09',
+                 'B11', 'B12', 'SCL', 'TCI', 'WVP']}
 
 
 class Stacker():
@@ -157,7 +166,8 @@ class Stacker():
             Required form : ['band1', 'band2', ... ]
         s2_resolution : int, optional
             Choose the band resolution of the Sentinel-2 bands. Can be `10`,
-            `20`, or `60`.
+            `20`, or `60`. By default the finest resolution at which all the
+            Sentinel-2 bands are available.
 
         Returns
         -------
@@ -176,17 +186,14 @@ class Stacker():
             RuntimeError("You must specify a resolution of int 10, 20, or 60"
                          " when stacking Sentinel-2 products.")
 
+        if s2_band_list and not s2_resolution:
+            # the finest resolution at which all the bands are available
+            s2_resolution = _finest_resolution(s2_band_list)
+
         s1_valid_bands = ['vv', 'vh']
-        s2_valid_bands = {'10': ['AOT', 'B02', 'B03', 'B04', 'B08', 'TCI',
-                                 'WVP'],
-                          '20': ['AOT', 'B02', 'B03', 'B04', 'B05', 'B06',
-                                 'B07', 'B8A', 'B11', 'B12', 'SCL', 'TCI',
-                                 'WVP'],
-                          '60': ['AOT', 'B02', 'B03', 'B04', 'B05', 'B06',
-                                 'B07', 'B8A', 'B09', 'B11', 'B12', 'SCL',
-                                 'TCI', 'WVP']}
+        s2_valid_bands = S2_BANDS[60]
         if s2_resolution:
-            s2_valid_bands = s2_valid_bands[str(s2_resolution)]
+            s2_valid_bands = S2_BANDS[int(s2_resolution)]
 
         if s1_band_list and s2_resolution:
             warnings.warn("Sentinel-1 GRD products are 10m resolution pixels."
@@ -214,6 +221,25 @@ class Stacker():
         if s2_resolution:
             self.s2_res = s2_resolution
 
+    def s2_processing_resolution(self):
+        """Returns the resolution in m the Sentinel-2 products need to be
+        processed at for the bands set with `set_bands`.
+
+        It can be passed to `gs_processor.batch_process` so that sen2cor
+        only produces the resolutions needed.
+
+        Returns
+        -------
+        int
+            The resolution, None if no Sentinel-2 bands have been set.
+
+        """
+
+        if not self.band_list or not self.band_list[1]:
+            return None
+
+        return int(self.s2_res)
+
     def generate_stacks(self):
         """Runs the data layer extraction and stacking process.
 
@@ -246,6 +272,7 @@ class Stacker():
             raise ValueError("Please set the band list via"
                              " .set_bands(band_list) before running.")
 
+        used = []
         for uuid, product in self.products.items():
             # get the filepath for the product files in .SAFE
             if product['platformname'] == 'Sentinel-1':
@@ -263,6 +290,10 @@ class Stacker():
             # extract bands from processed files
             for band in band_list:
                 self._extract_data(uuid, band)
+            used.append(uuid)
+
+        # keep the stacked products from being evicted
+        gs_localmanager.touch_products(used)
 
         self._generate_stacks()
 
@@ -582,12 +613,10 @@ class Stacker():
 
         # ESA product footprints are in WGS84 (epsg: 4326)
         for uuid, product in product_list.items():
-            product_start = datetime.datetime.strptime(
-                                                product['beginposition'][:10],
-                                                '%Y-%m-%d').date()
+            product = as_product(product)
+            product_start = product.begin.date()
             if self.start_date <= product_start <= self.end_date:
-                product_shape = shapely.wkt.loads(product['footprint'])
-                product_boundaries[uuid] = product_shape
+                product_boundaries[uuid] = product.shape
                 filtered_products[uuid] = product
 
         return filtered_products, product_boundaries
@@ -660,6 +689,17 @@ class Stacker():
         self.ROIs = ROIs
 
 
+def _finest_resolution(bands):
+    """Returns the finest resolution at which all the Sentinel-2 bands are
+    available, None if there is none."""
+
+    for resolution in sorted(S2_BANDS):
+        if set(bands) <= set(S2_BANDS[resolution]):
+            return resolution
+
+    return None
+
+
 class Stack(np.ndarray):
     """Used to add an attribute to an existing numpy array.
     adapted from:
@@ -0,0 +1,221 @@
+"""
+Inventory Benchmark
+
+Times the gs_localmanager inventory operations against synthetic inventories
+of increasing size and prints the scaling curves.
+
+Each inventory is built in a temporary directory holding a gs_config.json and
+a DATA_PATH of fake .SAFE directories and processed .tif files, so no ESA
+account or downloaded data is needed and the working directory is left alone.
+
+Usage::
+
+    python inventory_benchmark.py [SIZE ...]
+
+The default sizes are 1000, 10000 and 100000 products.
+"""
+
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from shapely.geometry import box
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+# products added one at a time, on top of the batch added inventory
+SINGLE_ADDS = 100
+# repetitions of the fast operations, the best time is reported
+REPEATS = 5
+TILES = ['{0}{1}{2}'.format(zone, band, square) for zone in range(29, 34)
+         for band in 'TU' for square in ['LE', 'LF', 'ME', 'MF', 'NE']]
+
+
+def make_product(i, rng):
+    """Returns a synthetic product record, uuid and info, in the inventory
+    format. Every tenth product is a processed product."""
+
+    uuid = '{0:08x}-0000-4000-8000-{1:012x}'.format(rng.getrandbits(32), i)
+    begin = (datetime.datetime(2017, 1, 1) +
+             datetime.timedelta(seconds=rng.randrange(2 * 365 * 86400)))
+    end = begin + datetime.timedelta(seconds=25)
+    stamp = begin.strftime('%Y%m%dT%H%M%S')
+    lon = rng.uniform(-10, 20)
+    lat = rng.uniform(40, 60)
+    footprint = box(lon, lat, lon + 1.5, lat + 1).wkt
+    tile = rng.choice(TILES)
+
+    if i % 2:
+        identifier = 'S2A_MSIL1C_{0}_N0206_R{1:03d}_T{2}_{0}'.format(
+            stamp, rng.randrange(1, 144), tile)
+        product = {'platformname': 'Sentinel-2',
+                   'processinglevel': 'Level-1C',
+                   'producttype': 'S2MSI1C',
+                   'cloudcoverpercentage': str(rng.uniform(0, 100)),
+                   'tileid': tile}
+    else:
+        identifier = ('S1A_IW_GRDH_1SDV_{0}_{1}_0{2:05d}_0{3:05X}_{4:04X}'
+                      '').format(stamp, end.strftime('%Y%m%dT%H%M%S'),
+                                 rng.randrange(99999), rng.randrange(0xFFFFF),
+                                 rng.randrange(0xFFFF))
+        product = {'platformname': 'Sentinel-1',
+                   'producttype': 'GRD',
+                   'polarisationmode': 'VV VH',
+                   'sensoroperationalmode': 'IW',
+                   'tileid': [[tile]]}
+
+    product.update({'identifier': identifier,
+                    'filename': identifier + '.SAFE',
+                    'beginposition': begin.isoformat() + '.000Z',
+                    'endposition': end.isoformat() + '.000Z',
+                    'ingestiondate': end.isoformat() + '.000Z',
+                    'footprint': footprint,
+                    'format': 'SAFE',
+                    'size': '{0:.2f} MB'.format(rng.uniform(500, 1200)),
+                    'status': 'ARCHIVED',
+                    'origin': uuid,
+                    'userprocessed': False})
+
+    if i % 10 == 9:
+        product['identifier'] = identifier + '_PROC_graph'
+        product['filename'] = identifier + '_PROC_graph.tif'
+        product['userprocessed'] = True
+        uuid = uuid + '-user'
+
+    return uuid, product
+
+
+def make_files(data_path, products):
+    """Creates the fake product files in the DATA_PATH."""
+
+    for product in products.values():
+        product_path = data_path.joinpath(product['filename'])
+        if product['filename'].endswith('.SAFE'):
+            product_path.mkdir()
+        else:
+            product_path.touch()
+
+
+def timed(function, *args, **kwargs):
+    """Returns the wall time in ms and the result of one call."""
+
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+
+    return (time.perf_counter() - started) * 1000, result
+
+
+def best_of(function, *args, **kwargs):
+    """Returns the best wall time in ms of REPEATS calls."""
+
+    return min(timed(function, *args, **kwargs)[0] for _ in range(REPEATS))
+
+
+def run(size, root):
+    """Benchmarks an inventory of the given size in the root directory and
+    returns the timings in ms keyed by operation."""
+
+    from getsentinel import gs_localmanager
+
+    rng = random.Random(size)
+    products = dict(make_product(i, rng) for i in range(size + SINGLE_ADDS))
+    uuids = list(products)
+    batch = {uuid: products[uuid] for uuid in uuids[:size]}
+    singles = {uuid: products[uuid] for uuid in uuids[size:]}
+
+    data_path = root.joinpath('data')
+    data_path.mkdir()
+    make_files(data_path, products)
+
+    timings = {}
+
+    timings['batch add'], _ = timed(gs_localmanager.add_new_products, batch)
+    started = time.perf_counter()
+    for uuid, product in singles.items():
+        gs_localmanager.add_new_products({uuid: product})
+    timings['single add'] = ((time.perf_counter() - started) * 1000 /
+                             len(singles))
+
+    # the DATA_PATH is only trusted to be unchanged once its modification
+    # time is well in the past, see check_integrity
+    time.sleep(gs_localmanager.MTIME_RESOLUTION_NS / 1e9 + 0.5)
+
+    # the first integrity check after the adds inspects the DATA_PATH
+    timings['check (scan)'], _ = timed(gs_localmanager.check_integrity)
+    timings['check (cached)'] = best_of(gs_localmanager.check_integrity)
+
+    gs_localmanager._inventory_cache.clear()
+    timings['inventory (cold)'], _ = timed(
+        gs_localmanager.get_product_inventory)
+    timings['inventory (warm)'] = best_of(
+        gs_localmanager.get_product_inventory)
+
+    sample = rng.choice(uuids)
+    timings['get_product'] = best_of(gs_localmanager.get_product, sample)
+    timings['find tile+month'] = best_of(
+        gs_localmanager.find, platform='S2', tile=TILES[0],
+        start=datetime.date(2018, 6, 1), end=datetime.date(2018, 6, 30))
+    timings['find level'] = best_of(gs_localmanager.find, level='L1C')
+    timings['intersecting'] = best_of(
+        gs_localmanager.products_intersecting, box(5, 50, 6, 51))
+
+    # a product removed from the DATA_PATH by hand
+    removed = data_path.joinpath(products[sample]['filename'])
+    if removed.is_dir():
+        removed.rmdir()
+    else:
+        removed.unlink()
+    timings['check (removal)'], _ = timed(gs_localmanager.check_integrity)
+
+    return timings
+
+
+def main(sizes):
+    """Runs the benchmark for each inventory size and prints the timings."""
+
+    results = {}
+    home = os.getcwd()
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            with root.joinpath('gs_config.json').open('w') as config_file:
+                json.dump({'esa_username': 'benchmark',
+                           'esa_password': 'benchmark',
+                           'sen2cor_path': '', 'snap_gpt': '',
+                           'data_path': 'data/', 'quicklooks_path': '',
+                           'is_set': True}, config_file)
+            os.chdir(temp_dir)
+            try:
+                print("Benchmarking an inventory of {0} products.".format(
+                    size))
+                results[size] = run(size, root)
+            finally:
+                os.chdir(home)
+
+    operations = list(results[sizes[0]].keys())
+    header = '{0:<18}'.format('ms') + ''.join(
+        '{0:>12}'.format(size) for size in sizes)
+    print('\n' + header)
+    print('-' * len(header))
+    for operation in operations:
+        print('{0:<18}'.format(operation) + ''.join(
+            '{0:>12.2f}'.format(results[size][operation]) for size in sizes))
+
+    if len(sizes) > 1:
+        # growth of each operation relative to the growth of the inventory
+        print('\nScaling from {0} to {1} products ({2:.0f}x):'.format(
+            sizes[0], sizes[-1], sizes[-1] / sizes[0]))
+        for operation in operations:
+            first = max(results[sizes[0]][operation], 1e-3)
+            print('{0:<18}{1:>11.1f}x'.format(
+                operation, results[sizes[-1]][operation] / first))
+
+    return results
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or DEFAULT_SIZES)